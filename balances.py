@@ -0,0 +1,168 @@
+from decimal import Decimal, ROUND_HALF_EVEN
+
+import numpy as np
+import pandas as pd
+
+
+BALANCE_KEY = ['wallet_address', 'token_address']
+# Balances are raw integer token amounts (balance * 10 ** decimals) and values are micro USD,
+# so comparing and subtracting them is exact and vectorized.
+# Raw columns are int64, or Python ints in an object column when an amount doesn't fit in int64
+# (e.g. over ~9.2e9 tokens at 9 decimals), which keeps them exact at the cost of speed.
+BALANCE_COLUMNS = BALANCE_KEY + ['balance_raw', 'decimals', 'value_micro']
+
+MICRO_USD = 1_000_000
+USD_DECIMALS = 6
+DEFAULT_DECIMALS = 9 # SPL tokens have at most 9 decimals, used when the API doesn't say
+_INT64_MAX = np.iinfo(np.int64).max
+# The largest float64 that still fits in an int64, 2 ** 63 itself would wrap to the minimum on conversion
+_FLOAT_INT64_MAX = np.nextafter(2.0 ** 63, 0)
+
+
+def _exact_raw(amount: float, decimals: int) -> int:
+    return int(Decimal(repr(amount)).scaleb(decimals).to_integral_value(ROUND_HALF_EVEN))
+
+def to_raw_amounts(balances, decimals) -> np.ndarray:
+    """
+    Convert UI amounts (floats) to raw integer amounts at each token's decimals.
+    Returns int64, or Python ints (object) if any amount is beyond the int64 range.
+    """
+    balances = np.asarray(balances, dtype='float64')
+    decimals = np.broadcast_to(np.asarray(decimals, dtype='int64'), balances.shape)
+    raw = np.rint(balances * np.power(10.0, decimals))
+    overflow = np.abs(raw) > _FLOAT_INT64_MAX
+    if not overflow.any():
+        return raw.astype('int64')
+
+    exact = np.where(overflow, 0, raw).astype('int64').astype(object)
+    for index in np.flatnonzero(overflow):
+        exact[index] = _exact_raw(float(balances[index]), int(decimals[index]))
+    return exact
+
+def to_micro_usd(values) -> np.ndarray:
+    return to_raw_amounts(values, USD_DECIMALS)
+
+def to_int_array(values) -> np.ndarray:
+    """
+    Raw amounts (e.g. Decimals read from NUMERIC columns) as int64, or as Python ints (object)
+    if any doesn't fit in int64
+    """
+    array = np.asarray(values)
+    if array.dtype.kind in 'iu':
+        return array.astype('int64')
+    ints = [int(value) for value in array.tolist()]
+    if all(-_INT64_MAX <= value <= _INT64_MAX for value in ints):
+        return np.array(ints, dtype='int64')
+    return np.array(ints, dtype=object)
+
+def from_raw_amounts(raw, decimals) -> np.ndarray:
+    """
+    Raw integer amounts back to UI amounts, for display
+    """
+    return np.asarray(raw, dtype='float64') / np.power(10.0, np.asarray(decimals, dtype='float64'))
+
+def _rescale_int(raw: int, from_decimals: int, to_decimals: int) -> int:
+    shift = to_decimals - from_decimals
+    if shift >= 0:
+        return raw * 10 ** shift
+    quotient, remainder = divmod(raw, 10 ** -shift)
+    return quotient + (2 * remainder >= 10 ** -shift)
+
+def _rescale(raw, from_decimals, to_decimals) -> np.ndarray:
+    """
+    Move raw amounts between decimals, rounding half up when scaling down.
+    Falls back to Python ints when scaling up leaves the int64 range.
+    """
+    if raw.dtype == object:
+        return np.array([
+            _rescale_int(int(amount), int(source), int(target))
+            for amount, source, target in zip(raw, from_decimals, to_decimals)
+        ], dtype=object)
+
+    shift = to_decimals - from_decimals
+    up = np.power(10, np.clip(shift, 0, 18), dtype='int64')
+    down = np.power(10, np.clip(-shift, 0, 18), dtype='int64')
+    if (np.abs(shift) > 18).any() or (np.abs(raw) > _INT64_MAX // up).any():
+        return _rescale(raw.astype(object), from_decimals, to_decimals)
+
+    quotient, remainder = np.divmod(raw * up, down)
+    return quotient + (remainder >= down - remainder)
+
+def _take(values, positions, fill=0) -> np.ndarray:
+    """
+    values[positions], with fill where the position is -1 (no row on that side of the join)
+    """
+    found = positions >= 0
+    taken = np.full(len(positions), fill, dtype=values.dtype)
+    taken[found] = values[positions[found]]
+    return taken
+
+def _common_dtype(*arrays):
+    """
+    Promote the arrays to Python ints if any of them is, so arithmetic between them can't overflow
+    """
+    if any(array.dtype == object for array in arrays):
+        return tuple(array.astype(object) for array in arrays)
+    return arrays
+
+
+def diff_balances(current: pd.DataFrame, previous: pd.DataFrame) -> pd.DataFrame:
+    """
+    Compare two balance snapshots keyed on (wallet_address, token_address).
+    A hash join in a single pass, pairs missing on either side count as a 0 balance
+    (new tokens and sold out tokens). Previous amounts stored at other decimals are rescaled
+    to the current ones. Returns only pairs whose balance changed, with the raw integer
+    columns plus UI amounts and USD values (floats) for display.
+    """
+    # Join row positions rather than the values, an outer join would turn int columns into floats around the gaps
+    merged = pd.merge(
+        current[BALANCE_KEY].assign(current_row=np.arange(len(current))),
+        previous[BALANCE_KEY].assign(previous_row=np.arange(len(previous))),
+        on=BALANCE_KEY,
+        how='outer',
+        sort=False,
+    )
+    current_rows = merged['current_row'].fillna(-1).to_numpy(dtype='int64')
+    previous_rows = merged['previous_row'].fillna(-1).to_numpy(dtype='int64')
+
+    current_decimals = _take(current['decimals'].to_numpy(dtype='int64'), current_rows, -1)
+    previous_decimals = _take(previous['decimals'].to_numpy(dtype='int64'), previous_rows, -1)
+    decimals = np.where(current_rows >= 0, current_decimals, previous_decimals)
+    previous_decimals = np.where(previous_rows >= 0, previous_decimals, decimals)
+
+    current_raw, previous_raw = _common_dtype(
+        _take(to_int_array(current['balance_raw']), current_rows),
+        _take(to_int_array(previous['balance_raw']), previous_rows),
+    )
+    previous_raw = _rescale(previous_raw, previous_decimals, decimals)
+    balance_change_raw = current_raw - previous_raw
+    current_value, previous_value = _common_dtype(
+        _take(to_int_array(current['value_micro']), current_rows),
+        _take(to_int_array(previous['value_micro']), previous_rows),
+    )
+    value_change_micro = current_value - previous_value
+
+    changes = pd.DataFrame({
+        'wallet_address': merged['wallet_address'],
+        'token_address': merged['token_address'],
+        'decimals': decimals,
+        'previous_balance_raw': previous_raw,
+        'current_balance_raw': current_raw,
+        'balance_change_raw': balance_change_raw,
+        'value_change_micro': value_change_micro,
+        'previous_balance': from_raw_amounts(previous_raw, decimals),
+        'current_balance': from_raw_amounts(current_raw, decimals),
+        'balance_change': from_raw_amounts(balance_change_raw, decimals),
+        'value_change': from_raw_amounts(value_change_micro, USD_DECIMALS),
+    })
+    return changes[np.asarray(balance_change_raw != 0, dtype=bool)].reset_index(drop=True)
+
+def significant(changes: pd.DataFrame, min_change: float = 0.5) -> pd.Series:
+    """
+    Mask of changes larger than min_change tokens, compared exactly on the raw amounts
+    """
+    threshold = to_raw_amounts(np.full(len(changes), min_change), changes['decimals'].to_numpy(dtype='int64'))
+    return pd.Series(
+        np.asarray(np.abs(changes['balance_change_raw'].to_numpy()) > threshold, dtype=bool),
+        index=changes.index
+    )
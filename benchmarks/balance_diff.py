@@ -0,0 +1,103 @@
+"""
+Benchmark the fixed-point balance diff against the old sort-and-assert alignment on Decimals.
+
+Run from the repo root:
+    python -m benchmarks.balance_diff [pairs]
+"""
+import sys
+import time
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+
+from balances import MICRO_USD, diff_balances, significant
+
+DECIMALS = 6
+
+
+def make_snapshots(pairs, tokens_per_wallet=100, changed_fraction=0.05, seed=0):
+    """
+    Build a full (wallet, token) grid for the current and previous snapshots,
+    with a fraction of the balances changed. Returns the old float/Decimal frames and the fixed-point ones.
+    """
+    rng = np.random.default_rng(seed)
+    wallet_count = pairs // tokens_per_wallet
+    wallets = np.repeat([f'wallet{i}' for i in range(wallet_count)], tokens_per_wallet)
+    tokens = np.tile([f'token{i}' for i in range(tokens_per_wallet)], wallet_count)
+
+    previous_balance = rng.uniform(0, 1_000_000, len(wallets)).round(6)
+    current_balance = previous_balance.copy()
+    changed = rng.random(len(wallets)) < changed_fraction
+    current_balance[changed] += rng.uniform(-1000, 1000, changed.sum()).round(6)
+
+    current = pd.DataFrame({
+        'wallet_address': wallets,
+        'token_address': tokens,
+        'balance': current_balance,
+        'value': current_balance * 0.01,
+    })
+    # Previous balances come from the db as Decimals, shuffled like an unordered query result
+    previous = pd.DataFrame({
+        'wallet_address': wallets,
+        'token_address': tokens,
+        'balance': [Decimal(str(balance)) for balance in previous_balance],
+        'value': [Decimal(str(balance * 0.01)) for balance in previous_balance],
+    }).sample(frac=1, random_state=seed)
+    return (current, previous), (to_fixed_point(current), to_fixed_point(previous))
+
+def to_fixed_point(snapshot):
+    return pd.DataFrame({
+        'wallet_address': snapshot['wallet_address'],
+        'token_address': snapshot['token_address'],
+        'balance_raw': [round(Decimal(balance) * 10 ** DECIMALS) for balance in snapshot['balance']],
+        'decimals': DECIMALS,
+        'value_micro': [round(Decimal(value) * MICRO_USD) for value in snapshot['value']],
+    }).astype({'balance_raw': 'int64', 'value_micro': 'int64'})
+
+
+def sort_and_subtract(current, previous):
+    """
+    The previous approach: sort both sides, assert equal length and subtract by position
+    """
+    current = current.sort_values(['wallet_address', 'token_address']).reset_index(drop=True)
+    previous = previous.sort_values(['wallet_address', 'token_address']).reset_index(drop=True)
+    assert len(current) == len(previous)
+    changes = pd.DataFrame({
+        'wallet_address': current['wallet_address'],
+        'token_address': current['token_address'],
+        'previous_balance': previous['balance'],
+        'current_balance': current['balance'],
+        'balance_change': current['balance'].apply(Decimal) - previous['balance'],
+        'value_change': current['value'].apply(Decimal) - previous['value'],
+    })
+    return changes[changes['balance_change'] != 0]
+
+
+def best_of(func, *args, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    pairs = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    (current, previous), (current_raw, previous_raw) = make_snapshots(pairs)
+
+    # Decimal(float) noise shows up as tiny changes in the old approach, so compare significant changes only
+    old_changes = sort_and_subtract(current, previous)
+    new_changes = diff_balances(current_raw, previous_raw)
+    assert (abs(old_changes['balance_change']) > 0.5).sum() == significant(new_changes).sum()
+
+    old = best_of(sort_and_subtract, current, previous)
+    new = best_of(diff_balances, current_raw, previous_raw)
+    print(f'{len(current):,} pairs')
+    print(f'sort and subtract: {old * 1000:,.1f} ms')
+    print(f'diff_balances:     {new * 1000:,.1f} ms ({old / new:,.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
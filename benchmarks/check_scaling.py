@@ -0,0 +1,226 @@
+"""
+Benchmark check_wallet_balances and check_trades end to end against the local fake API
+(benchmarks/fake_solana_tracker.py) and a throwaway Postgres.
+
+Every run truncates and reseeds the tracker tables in BENCHMARK_DATABASE_URL, never point it at real data.
+
+Run from the repo root:
+    BENCHMARK_DATABASE_URL=postgresql://localhost/wallet_tracker_bench python -m benchmarks.check_scaling \\
+        [--wallets 10,100,1000,10000] [--latency-ms 50] [--rate-limit-fraction 0.01] [--no-memory]
+
+Reports wall time, time per stage (summed over concurrent calls), peak Python memory (tracemalloc)
+and API calls per wallet count.
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+import urllib.request
+from collections import Counter
+
+FAKE_API_PORT = 8765
+
+# The tracker reads its settings on import, so point it at the fake API and benchmark db first
+if __name__ == '__main__':
+    if not os.getenv('BENCHMARK_DATABASE_URL'):
+        sys.exit('Set BENCHMARK_DATABASE_URL to a throwaway database, its tracker tables are truncated on every run')
+    os.environ['DATABASE_URL'] = os.environ['BENCHMARK_DATABASE_URL']
+    os.environ['SOLANA_TRACKER_BASE_URL'] = f'http://127.0.0.1:{FAKE_API_PORT}'
+    os.environ['SOLANA_TRACKER_API_KEY_1'] = 'benchmark'
+    os.environ.setdefault('SOLANA_TRACKER_REQUESTS_PER_SECOND', '1000')
+    os.environ.setdefault('SOLANA_TRACKER_BURST', '100')
+    for name in list(os.environ):
+        if name.startswith('SOLANA_TRACKER_API_KEY_') and name != 'SOLANA_TRACKER_API_KEY_1':
+            del os.environ[name]
+
+from psycopg2.extras import execute_values
+
+import db
+import wallet_tracker
+from balances import MICRO_USD
+from benchmarks.fake_solana_tracker import FAKE_TOKEN_DECIMALS, TOKEN_POOL_SIZE, token_address, wallet_holdings
+from solana_tracker import close_session
+
+TRACKED_TOKENS = TOKEN_POOL_SIZE // 2
+TRADE_WALLET_EVERY = 50
+
+
+def seed_database(wallet_count, seed=0):
+    """
+    Reset the tracker tables and seed wallets, tracked tokens, the latest balances and one history
+    snapshot, matching what the fake API returns before its changes are applied
+    """
+    db.initialize_db()
+    conn = db.get_db_connection()
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            TRUNCATE wallets, tokens, wallet_trades, wallet_balance_latest, wallet_balance_history,
+                wallet_checks, wallet_trade_cursors, notification_outbox CASCADE;
+        """)
+        wallets = [
+            (f'FakeWallet{index:06d}'.ljust(44, 'x'), f'Phantom {index}' if index % TRADE_WALLET_EVERY == 0 else f'Wallet {index}')
+            for index in range(wallet_count)
+        ]
+        execute_values(cursor, "INSERT INTO wallets (wallet_address, alias) VALUES %s", wallets)
+        tokens = [(token_address(index), f'Token {index}', f'T{index}') for index in range(TRACKED_TOKENS)]
+        execute_values(cursor, "INSERT INTO tokens (token_address, name, symbol) VALUES %s", tokens)
+
+        tracked = {token[0] for token in tokens}
+        balances = [
+            (wallet_address, token, round(balance * 10 ** FAKE_TOKEN_DECIMALS), FAKE_TOKEN_DECIMALS, round(value * MICRO_USD))
+            for wallet_address, _ in wallets
+            for token, balance, value in wallet_holdings(wallet_address, seed)
+            if token in tracked
+        ]
+        execute_values(cursor, """
+            INSERT INTO wallet_balance_latest (wallet_address, token_address, balance_raw, decimals, value_micro, updated_at)
+            VALUES %s
+        """, balances, template='(%s, %s, %s, %s, %s, LOCALTIMESTAMP - INTERVAL \'1 hour\')', page_size=10_000)
+        # Stay inside the partitions initialize_db creates
+        cursor.execute("""
+            INSERT INTO wallet_balance_history (wallet_address, token_address, timestamp, balance_raw, decimals, value_micro)
+            SELECT wallet_address, token_address, GREATEST(date_trunc('month', LOCALTIMESTAMP), updated_at), balance_raw, decimals, value_micro
+            FROM wallet_balance_latest;
+
+            INSERT INTO wallet_checks (wallet_address, checked_at)
+            SELECT wallet_address, LOCALTIMESTAMP - INTERVAL '1 hour' FROM wallets;
+        """)
+    conn.commit()
+    conn.close()
+
+
+def timed(stages, name, func):
+    """
+    Wrap func so its time is added to stages[name]
+    """
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                stages[name] += time.perf_counter() - start
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stages[name] += time.perf_counter() - start
+    return wrapper
+
+def instrument(stages):
+    """
+    Time the stages of the checks by wrapping the functions wallet_tracker calls
+    """
+    for attribute, stage in [
+        ('get_previous_wallet_balance', 'load previous balances'),
+        ('get_wallet_balance', 'fetch balances (sum)'),
+        ('diff_balances', 'diff (sum)'),
+        ('upsert_wallet_balances', 'write balances (sum)'),
+        ('get_wallet_trades', 'fetch trades'),
+        ('upsert_wallet_trades', 'write trades'),
+    ]:
+        setattr(wallet_tracker, attribute, timed(stages, stage, getattr(wallet_tracker, attribute)))
+
+def fetch_api_stats():
+    with urllib.request.urlopen(f'http://127.0.0.1:{FAKE_API_PORT}/_stats') as response:
+        return Counter(json.load(response))
+
+def start_fake_api(args):
+    process = subprocess.Popen([
+        sys.executable, '-m', 'benchmarks.fake_solana_tracker',
+        '--port', str(FAKE_API_PORT),
+        '--latency-ms', str(args.latency_ms),
+        '--rate-limit-fraction', str(args.rate_limit_fraction),
+        '--changed-fraction', str(args.changed_fraction),
+    ])
+    for _ in range(100):
+        try:
+            fetch_api_stats()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError('Fake API did not start')
+
+
+async def benchmark(wallet_count, stages, measure_memory):
+    seed_start = time.perf_counter()
+    await asyncio.to_thread(seed_database, wallet_count)
+    seed_seconds = time.perf_counter() - seed_start
+
+    stages.clear()
+    api_before = fetch_api_stats()
+    if measure_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+
+    await db.init_db_pool()
+    try:
+        stage_start = time.perf_counter()
+        await wallet_tracker.initialize()
+        stages['load registry'] += time.perf_counter() - stage_start
+
+        stage_start = time.perf_counter()
+        changes, _ = await wallet_tracker.check_wallet_balances()
+        stages['check_wallet_balances'] += time.perf_counter() - stage_start
+
+        stage_start = time.perf_counter()
+        trades = await wallet_tracker.check_trades()
+        stages['check_trades'] += time.perf_counter() - stage_start
+    finally:
+        await db.close_db_pool()
+
+    wall_seconds = time.perf_counter() - start
+    peak_bytes = None
+    if measure_memory:
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    api_calls = fetch_api_stats() - api_before
+
+    print(f'\n{wallet_count:,} wallets (seeded in {seed_seconds:.1f}s)')
+    print(f'  wall time:                  {wall_seconds:8.2f} s')
+    for stage, seconds in stages.items():
+        print(f'  {stage + ":":<28}{seconds:8.2f} s')
+    if peak_bytes is not None:
+        print(f'  peak memory:                {peak_bytes / 2**20:8.1f} MiB')
+    for name, count in sorted(api_calls.items()):
+        print(f'  {name}: {count:,}')
+    print(f'  {len(changes):,} balance changes, {len(trades):,} new trades')
+
+async def run(wallet_counts, measure_memory):
+    stages = Counter()
+    instrument(stages)
+    try:
+        for wallet_count in wallet_counts:
+            await benchmark(wallet_count, stages, measure_memory)
+    finally:
+        await close_session()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--wallets', default='10,100,1000,10000', help='comma separated wallet counts')
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--rate-limit-fraction', type=float, default=0.0)
+    parser.add_argument('--changed-fraction', type=float, default=0.05)
+    parser.add_argument('--no-memory', action='store_true', help='skip tracemalloc, which slows the run down')
+    args = parser.parse_args()
+
+    fake_api = start_fake_api(args)
+    try:
+        asyncio.run(run([int(count) for count in args.wallets.split(',')], not args.no_memory))
+    finally:
+        fake_api.terminate()
+
+
+if __name__ == '__main__':
+    main()
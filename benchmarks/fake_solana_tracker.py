@@ -0,0 +1,209 @@
+"""
+Local stand-in for the data.solanatracker.io endpoints the tracker uses, for offline benchmarks.
+
+Wallet holdings are derived from the wallet address and seed, so a benchmark can seed the db with
+the same balances the server returns and have a known fraction of them change.
+Payloads carry the pools/events/risk blobs the client drops, at roughly their real size.
+
+Run from the repo root:
+    python -m benchmarks.fake_solana_tracker [--port 8765] [--latency-ms 50] [--rate-limit-fraction 0.01]
+Request counts are served at /_stats.
+"""
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+TOKEN_POOL_SIZE = 500
+TOKENS_PER_WALLET = 20
+TRADES_PER_PAGE = 100
+FAKE_TOKEN_DECIMALS = 6
+
+
+def token_address(index):
+    return f'FakeMint{index:04d}'.ljust(44, 'x')
+
+def wallet_holdings(wallet_address, seed=0, tokens_per_wallet=TOKENS_PER_WALLET):
+    """
+    The (token_address, balance, value) rows a wallet holds, the same on every call
+    """
+    rng = random.Random(f'{seed}:{wallet_address}')
+    holdings = []
+    for index in rng.sample(range(TOKEN_POOL_SIZE), tokens_per_wallet):
+        balance = round(rng.uniform(1, 10_000_000), 6)
+        holdings.append((token_address(index), balance, round(balance * rng.uniform(0.000001, 0.01), 6)))
+    return holdings
+
+def _pool(rng, mint):
+    return {
+        'poolId': f'Pool{rng.getrandbits(64):x}',
+        'liquidity': {'quote': rng.uniform(0, 1e4), 'usd': rng.uniform(0, 1e6)},
+        'price': {'quote': rng.random(), 'usd': rng.random()},
+        'tokenSupply': rng.uniform(1e6, 1e12),
+        'lpBurn': rng.randint(0, 100),
+        'tokenAddress': mint,
+        'marketCap': {'quote': rng.uniform(0, 1e6), 'usd': rng.uniform(0, 1e8)},
+        'market': rng.choice(['raydium', 'orca', 'meteora', 'pumpfun']),
+        'quoteToken': 'So11111111111111111111111111111111111111112',
+        'decimals': FAKE_TOKEN_DECIMALS,
+        'security': {'freezeAuthority': None, 'mintAuthority': None},
+        'lastUpdated': int(time.time() * 1000),
+        'deployer': f'Deployer{rng.getrandbits(64):x}',
+        'txns': {'buys': rng.randint(0, 100_000), 'sells': rng.randint(0, 100_000), 'total': rng.randint(0, 200_000), 'volume': rng.uniform(0, 1e7)},
+    }
+
+def _token(rng, mint):
+    return {
+        'name': f'Token {mint[:12]}',
+        'symbol': mint[8:12],
+        'mint': mint,
+        'uri': f'https://example.invalid/{mint}.json',
+        'decimals': FAKE_TOKEN_DECIMALS,
+        'image': f'https://example.invalid/{mint}.png',
+        'description': 'Synthetic token for benchmarks ' * 4,
+        'hasFileMetaData': True,
+        'createdOn': 'https://pump.fun',
+    }
+
+def _holding(rng, mint, balance, value):
+    return {
+        'token': _token(rng, mint),
+        'pools': [_pool(rng, mint) for _ in range(rng.randint(1, 3))],
+        'events': {
+            period: {'priceChangePercentage': rng.uniform(-50, 50)}
+            for period in ('1m', '5m', '15m', '30m', '1h', '2h', '3h', '4h', '5h', '6h', '12h', '24h')
+        },
+        'risk': {
+            'rugged': False,
+            'risks': [
+                {'name': 'Low Liquidity', 'description': 'The total liquidity for this token is low', 'level': 'warning', 'score': 1000},
+            ][:rng.randint(0, 1)],
+            'score': rng.randint(0, 10),
+            'jupiterVerified': rng.random() < 0.5,
+        },
+        'buys': rng.randint(0, 10_000),
+        'sells': rng.randint(0, 10_000),
+        'txns': rng.randint(0, 20_000),
+        'balance': balance,
+        'value': value,
+    }
+
+
+class FakeSolanaTracker:
+    """
+    aiohttp app serving /wallet/{address}, /wallet/{address}/trades and /tokens/{address}.
+    latency_ms: added to every request
+    rate_limit_fraction: share of requests answered with a 429 and Retry-After: retry_after_seconds
+    changed_fraction: share of each wallet's balances that differ from wallet_holdings
+    """
+    def __init__(self, latency_ms=50, rate_limit_fraction=0.0, retry_after_seconds=1,
+                 changed_fraction=0.05, seed=0, tokens_per_wallet=TOKENS_PER_WALLET):
+        self.latency_ms = latency_ms
+        self.rate_limit_fraction = rate_limit_fraction
+        self.retry_after_seconds = retry_after_seconds
+        self.changed_fraction = changed_fraction
+        self.seed = seed
+        self.tokens_per_wallet = tokens_per_wallet
+        self.stats = Counter()
+        self._rng = random.Random(seed)
+
+    def create_app(self) -> web.Application:
+        app = web.Application(middlewares=[self._simulate])
+        app.router.add_get('/wallet/{address}', self.wallet)
+        app.router.add_get('/wallet/{address}/trades', self.wallet_trades)
+        app.router.add_get('/tokens/{address}', self.token)
+        app.router.add_get('/_stats', self.get_stats)
+        return app
+
+    @web.middleware
+    async def _simulate(self, request, handler):
+        if request.path == '/_stats':
+            return await handler(request)
+
+        endpoint = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+        self.stats[f'requests {endpoint}'] += 1
+        await asyncio.sleep(self.latency_ms / 1000)
+        if self._rng.random() < self.rate_limit_fraction:
+            self.stats['429s'] += 1
+            return web.Response(status=429, headers={'Retry-After': str(self.retry_after_seconds)})
+        return await handler(request)
+
+    async def wallet(self, request):
+        address = request.match_info['address']
+        rng = random.Random(f'{self.seed}:payload:{address}:{time.monotonic_ns()}')
+        tokens = []
+        for mint, balance, value in wallet_holdings(address, self.seed, self.tokens_per_wallet):
+            if rng.random() < self.changed_fraction:
+                balance = round(balance * rng.uniform(0.5, 1.5), 6)
+            tokens.append(_holding(rng, mint, balance, value))
+        return web.json_response({
+            'tokens': tokens,
+            'total': sum(token['value'] for token in tokens),
+            'totalSol': 0,
+        })
+
+    async def wallet_trades(self, request):
+        address = request.match_info['address']
+        page = int(request.query.get('cursor', 0))
+        rng = random.Random(f'{self.seed}:trades:{address}:{page}')
+        now_ms = int(time.time() * 1000)
+        trades = []
+        for index in range(TRADES_PER_PAGE):
+            from_mint, to_mint = token_address(rng.randrange(TOKEN_POOL_SIZE)), token_address(rng.randrange(TOKEN_POOL_SIZE))
+            trades.append({
+                'tx': f'Tx{address}{page:04d}{index:04d}',
+                'from': {'address': from_mint, 'amount': rng.uniform(1, 1e6), 'token': _token(rng, from_mint)},
+                'to': {'address': to_mint, 'amount': rng.uniform(1, 1e6), 'token': _token(rng, to_mint)},
+                'price': {'usd': rng.random(), 'sol': rng.random()},
+                'volume': {'usd': rng.uniform(1, 1e4), 'sol': rng.uniform(0, 100)},
+                'wallet': address,
+                'program': 'raydium',
+                'time': now_ms - (page * TRADES_PER_PAGE + index) * 60_000,
+            })
+        return web.json_response({'trades': trades, 'nextCursor': str(page + 1), 'hasNextPage': True})
+
+    async def token(self, request):
+        address = request.match_info['address']
+        rng = random.Random(f'{self.seed}:token:{address}')
+        holding = _holding(rng, address, 0, 0)
+        return web.json_response({
+            'token': holding['token'],
+            'pools': holding['pools'],
+            'events': holding['events'],
+            'risk': holding['risk'],
+            'buys': holding['buys'],
+            'sells': holding['sells'],
+            'txns': holding['txns'],
+        })
+
+    async def get_stats(self, request):
+        return web.json_response(dict(self.stats))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--rate-limit-fraction', type=float, default=0.0)
+    parser.add_argument('--retry-after-seconds', type=float, default=1)
+    parser.add_argument('--changed-fraction', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tokens-per-wallet', type=int, default=TOKENS_PER_WALLET)
+    args = parser.parse_args()
+
+    server = FakeSolanaTracker(
+        latency_ms=args.latency_ms,
+        rate_limit_fraction=args.rate_limit_fraction,
+        retry_after_seconds=args.retry_after_seconds,
+        changed_fraction=args.changed_fraction,
+        seed=args.seed,
+        tokens_per_wallet=args.tokens_per_wallet,
+    )
+    web.run_app(server.create_app(), host='127.0.0.1', port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
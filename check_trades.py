@@ -6,33 +6,64 @@ from dotenv import load_dotenv
 from discord import Webhook
 
 from wallet_tracker import initialize, check_trades
-from utils import create_wallet_trade_embed, logger
+from db import init_db_pool, close_db_pool
+from outbox import TRADES_CHANNEL, deliver_pending
+from solana_tracker import close_session
+from utils import logger
+from metrics import log_summary
+from profiling import profiled
 
 load_dotenv()
 DISCORD_WEBHOOK_TRADES_URL = os.environ['DISCORD_WEBHOOK_TRADES_URL']
 
+async def log_status(message: str):
+    logger.info(message)
+
+async def check_and_enqueue_trades() -> int:
+    """
+    Check trades, queueing new ones in the notification outbox in the same transaction as they are stored,
+    expects the registry to be loaded. Returns the number of trades queued.
+    """
+    logger.info('Checking trades...')
+    trades = await check_trades(status_callback=log_status, notification_channel=TRADES_CHANNEL)
+    
+    if len(trades) == 0:
+        logger.info('No trades to send')
+        return 0
+    
+    logger.info(f'Queued {len(trades)} trades')
+    return len(trades)
+
+async def check_and_send_trades(webhook: Webhook):
+    """
+    Check trades, then send everything pending in the outbox to the webhook,
+    including trades from earlier runs that failed to send
+    """
+    await check_and_enqueue_trades()
+    sent = await deliver_pending(TRADES_CHANNEL, webhook)
+    if sent:
+        logger.info(f'Sent {sent} trades')
+
 async def run_check_trades():
     async with aiohttp.ClientSession() as session:
         webhook = Webhook.from_url(DISCORD_WEBHOOK_TRADES_URL, session=session)
-        
-        async def log_status(message: str):
-            logger.info(message)        
 
         logger.info('Initializing trades tracker...')
         await initialize()
 
-        logger.info('Checking trades...')
-        trades = await check_trades(status_callback=log_status)
-        
-        if len(trades) == 0:
-            logger.info('No trades to send')
-            return
-        
-        logger.info(f'Sending {len(trades)} trades...')
-        
-        embed = create_wallet_trade_embed(trades)
-        await webhook.send(embed=embed)
+        await check_and_send_trades(webhook)
     
         
+async def main():
+    await init_db_pool()
+    try:
+        await run_check_trades()
+    finally:
+        await close_session()
+        await close_db_pool()
+        log_summary(logger, 'check_trades')
+
 if __name__ == '__main__':
-    asyncio.run(run_check_trades())
+    # PROFILE=true or --profile writes a CPU and memory profile of the run to PROFILE_DIR
+    with profiled('check_trades'):
+        asyncio.run(main())
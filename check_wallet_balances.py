@@ -5,43 +5,98 @@ import aiohttp
 from dotenv import load_dotenv
 from discord import Webhook
 
-from wallet_tracker import initialize, check_wallet_balances
-from utils import create_wallet_balance_change_embed, create_token_flow_summary_embed, logger
+from wallet_tracker import initialize, stream_wallet_balances
+from db import init_db_pool, close_db_pool, enqueue_notifications
+from outbox import BALANCE_CHANGES_CHANNEL, OUTBOX_POLL_SECONDS, deliver_pending
+from polling import ADAPTIVE_POLLING, select_due_wallets
+from solana_tracker import close_session
+from utils import MESSAGE_MAX_CONTENT_CHARS, logger
+from metrics import log_summary
+from profiling import profiled
 
 load_dotenv()
 DISCORD_WEBHOOK_WALLET_TRACKER_URL = os.environ['DISCORD_WEBHOOK_WALLET_TRACKER_URL']
 
+async def log_status(message: str):
+    logger.info(message)
+
+async def check_and_enqueue_wallet_balances() -> int:
+    """
+    Check wallet balances, queueing the changes in the notification outbox together with each wallet's
+    balance write, expects the registry to be loaded. Returns the number of changes queued.
+    An interrupted run is resumed, only checking the wallets it had left.
+    """
+    logger.info('Checking wallet balances...')
+    queued = 0
+    failed = []
+
+    async for result in stream_wallet_balances(
+        status_callback=log_status,
+        # Only check the wallets that are due, based on their recent activity and value
+        wallet_filter=select_due_wallets if ADAPTIVE_POLLING else None,
+        notification_channel=BALANCE_CHANGES_CHANNEL,
+        resumable=True,
+    ):
+        if result.error:
+            failed.append(result)
+            continue
+        if result.changes:
+            logger.info(f'{len(result.changes)} balance changes for {result.wallet["alias"]}')
+        queued += len(result.changes)
+
+    if failed:
+        logger.warning(f'Failed to check {len(failed)} wallets: ' + ', '.join(f'{result.wallet["alias"]} ({result.error})' for result in failed))
+        aliases = ', '.join(result.wallet['alias'] for result in failed)
+        await enqueue_notifications([(BALANCE_CHANGES_CHANNEL, {
+            'content': f'Failed to check {len(failed)} wallets: {aliases}'[:MESSAGE_MAX_CONTENT_CHARS]
+        })])
+
+    if queued == 0:
+        # Adaptive polling runs often on a few wallets, so don't report every empty run
+        if not ADAPTIVE_POLLING and not failed:
+            await enqueue_notifications([(BALANCE_CHANGES_CHANNEL, {'content': 'No significant balance changes'})])
+        logger.info('No changes to send')
+        return queued
+
+    logger.info(f'Queued {queued} wallet balance changes')
+    return queued
+
+async def check_and_send_wallet_balances(webhook: Webhook):
+    """
+    Check wallet balances, sending what is pending in the outbox to the webhook every OUTBOX_POLL_SECONDS
+    while the check runs and once more at the end, including changes from earlier runs that failed to send
+    """
+    check = asyncio.create_task(check_and_enqueue_wallet_balances())
+    sent = 0
+    try:
+        while not check.done():
+            await asyncio.wait({check}, timeout=OUTBOX_POLL_SECONDS)
+            sent += await deliver_pending(BALANCE_CHANGES_CHANNEL, webhook)
+        await check
+    finally:
+        check.cancel()
+    logger.info(f'Sent {sent} wallet balance notifications')
+
 async def run_check_wallet_balances():
     async with aiohttp.ClientSession() as session:
         webhook = Webhook.from_url(DISCORD_WEBHOOK_WALLET_TRACKER_URL, session=session)
-        
-        async def log_status(message: str):
-            logger.info(message)        
 
         logger.info('Initializing wallet tracker...')
         await initialize()
 
-        logger.info('Checking wallet balances...')
-        changes, previous_check_time = await check_wallet_balances(status_callback=log_status)
-        
-        if len(changes) == 0:
-            await webhook.send(content='No significant balance changes')
-            logger.info('No changes to send')
-            return
-        
-        logger.info(f'Sending {len(changes)} wallet balance changes...')
-        
-        CHANGES_PER_EMBED = 20
-        batches = [changes[i:i + CHANGES_PER_EMBED] 
-                    for i in range(0, len(changes), CHANGES_PER_EMBED)]
-        
-        for page, batch in enumerate(batches, 1):
-            embed = create_wallet_balance_change_embed(batch, previous_check_time if page == 1 else None, page, len(batches))
-            await webhook.send(embed=embed)
-        
-        summary_embed = create_token_flow_summary_embed(changes)
-        await webhook.send(embed=summary_embed)
+        await check_and_send_wallet_balances(webhook)
         
 
+async def main():
+    await init_db_pool()
+    try:
+        await run_check_wallet_balances()
+    finally:
+        await close_session()
+        await close_db_pool()
+        log_summary(logger, 'check_wallet_balances')
+
 if __name__ == '__main__':
-    asyncio.run(run_check_wallet_balances())
+    # PROFILE=true or --profile writes a CPU and memory profile of the run to PROFILE_DIR
+    with profiled('check_wallet_balances'):
+        asyncio.run(main())
@@ -1,16 +1,252 @@
+import asyncio
+import datetime
+import json
 import os
 
 from dotenv import load_dotenv
 import psycopg2
-from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2 import sql
+from psycopg2.extras import Json, RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
+
+import metrics
 
 load_dotenv()
 
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', 1))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', 5))
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv('DB_POOL_TIMEOUT_SECONDS', 30))
+HISTORY_PARTITION_MONTHS_AHEAD = int(os.getenv('HISTORY_PARTITION_MONTHS_AHEAD', 2))
+HISTORY_RETENTION_MONTHS = int(os.getenv('HISTORY_RETENTION_MONTHS', 0))
+BALANCE_HISTORY_MODE = os.getenv('BALANCE_HISTORY_MODE', 'delta')
+
+_pool = None
+_pool_slots = None
+_pool_lock = None
+_history_partitions_checked_on = None
+_registry_listener = None
+
 def get_db_connection():
     DATABASE_URL = os.environ['DATABASE_URL']
     conn = psycopg2.connect(DATABASE_URL)
     return conn
 
+async def init_db_pool():
+    """
+    Create the connection pool and open DB_POOL_MIN_SIZE connections up front
+    """
+    global _pool, _pool_slots, _pool_lock
+    if _pool is not None:
+        return _pool
+
+    if _pool_lock is None:
+        _pool_lock = asyncio.Lock()
+    async with _pool_lock:
+        if _pool is None:
+            DATABASE_URL = os.environ['DATABASE_URL']
+            _pool = await asyncio.to_thread(ThreadedConnectionPool, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DATABASE_URL)
+            _pool_slots = asyncio.Semaphore(DB_POOL_MAX_SIZE)
+    return _pool
+
+async def close_db_pool():
+    """
+    Close all pooled connections
+    """
+    global _pool, _pool_slots
+    if _pool is not None:
+        _pool.closeall()
+    _pool = None
+    _pool_slots = None
+
+def _run_in_connection(pool, query, cursor_factory):
+    conn = pool.getconn()
+    try:
+        with conn.cursor(cursor_factory=cursor_factory) as cursor:
+            result = query(cursor)
+        conn.commit()
+        return result
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        # Broken connections are discarded so the pool reconnects on the next call
+        pool.putconn(conn, close=bool(conn.closed))
+
+async def run_query(query, cursor_factory=None):
+    """
+    Run query(cursor) on a pooled connection in a worker thread and commit.
+    Waits up to DB_POOL_TIMEOUT_SECONDS for a free connection.
+    """
+    pool = await init_db_pool()
+    # Queries are defined inside the function they belong to, label them by that function
+    operation = query.__qualname__.split('.')[0]
+    with metrics.timer('db_pool_wait', operation=operation):
+        await asyncio.wait_for(_pool_slots.acquire(), DB_POOL_TIMEOUT_SECONDS)
+    try:
+        with metrics.timer('db_query', operation=operation):
+            return await asyncio.to_thread(_run_in_connection, pool, query, cursor_factory)
+    finally:
+        _pool_slots.release()
+
+
+def _add_months(month_start, months):
+    month_index = month_start.year * 12 + month_start.month - 1 + months
+    return datetime.date(month_index // 12, month_index % 12 + 1, 1)
+
+def _history_partition_name(month_start):
+    return f'wallet_balance_history_{month_start:%Y_%m}'
+
+def create_history_table(cursor):
+    """
+    Create wallet_balance_history partitioned by month on timestamp.
+    An existing unpartitioned table is kept as the partition for everything before the current month.
+    """
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('wallet_balance_history')")
+    row = cursor.fetchone()
+    if row and row[0] == 'p':
+        cursor.execute("ALTER TABLE wallet_balance_history ADD COLUMN IF NOT EXISTS carried_forward BOOLEAN NOT NULL DEFAULT FALSE;")
+        return
+
+    if row:
+        cursor.execute("""
+            ALTER TABLE wallet_balance_history RENAME TO wallet_balance_history_legacy;
+            ALTER TABLE wallet_balance_history_legacy RENAME CONSTRAINT wallet_balance_history_pkey TO wallet_balance_history_legacy_pkey;
+            ALTER TABLE wallet_balance_history_legacy ADD COLUMN IF NOT EXISTS carried_forward BOOLEAN NOT NULL DEFAULT FALSE;
+        """)
+
+    cursor.execute("""
+        CREATE TABLE wallet_balance_history (
+            wallet_address VARCHAR(128) REFERENCES wallets(wallet_address),
+            token_address VARCHAR(128) REFERENCES tokens(token_address),
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            balance_raw NUMERIC(39, 0) NOT NULL,
+            decimals SMALLINT NOT NULL,
+            value_micro NUMERIC(39, 0) NOT NULL,
+            carried_forward BOOLEAN NOT NULL DEFAULT FALSE,
+            PRIMARY KEY (wallet_address, token_address, timestamp)
+        ) PARTITION BY RANGE (timestamp);
+        CREATE INDEX IF NOT EXISTS wallet_balance_history_timestamp_idx ON wallet_balance_history (timestamp);
+    """)
+    current_month = maintain_history_partitions(cursor)
+
+    if row:
+        # Rows from this month move into the new monthly partition, the rest stay in place
+        cursor.execute("""
+            WITH moved AS (
+                DELETE FROM wallet_balance_history_legacy
+                WHERE timestamp >= %s
+                RETURNING wallet_address, token_address, timestamp, balance_raw, decimals, value_micro
+            )
+            INSERT INTO wallet_balance_history (wallet_address, token_address, timestamp, balance_raw, decimals, value_micro)
+            SELECT * FROM moved
+        """, (current_month,))
+        cursor.execute(
+            "ALTER TABLE wallet_balance_history ATTACH PARTITION wallet_balance_history_legacy FOR VALUES FROM (MINVALUE) TO (%s)",
+            (current_month.isoformat(),)
+        )
+
+def maintain_history_partitions(cursor):
+    """
+    Create monthly history partitions up to HISTORY_PARTITION_MONTHS_AHEAD months ahead and
+    detach partitions older than HISTORY_RETENTION_MONTHS (0 keeps everything).
+    Detached partitions are left in place as standalone tables. With retention on, balances are first
+    carried forward into the current month, see carry_forward_balances.
+    Returns the start of the current month.
+    """
+    cursor.execute("SELECT date_trunc('month', LOCALTIMESTAMP)::date")
+    current_month = cursor.fetchone()[0]
+
+    for offset in range(HISTORY_PARTITION_MONTHS_AHEAD + 1):
+        month_start = _add_months(current_month, offset)
+        cursor.execute(
+            sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF wallet_balance_history FOR VALUES FROM (%s) TO (%s)").format(
+                sql.Identifier(_history_partition_name(month_start))
+            ),
+            (month_start.isoformat(), _add_months(month_start, 1).isoformat())
+        )
+
+    if HISTORY_RETENTION_MONTHS > 0:
+        carry_forward_balances(cursor, current_month)
+        cutoff = _add_months(current_month, -HISTORY_RETENTION_MONTHS)
+        cursor.execute("""
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'wallet_balance_history'::regclass
+        """)
+        partitions = [name for (name,) in cursor.fetchall()]
+        monthly = {
+            name: datetime.datetime.strptime(name[-7:], '%Y_%m').date()
+            for name in partitions
+            if name != 'wallet_balance_history_legacy'
+        }
+
+        expired = [name for name, month_start in monthly.items() if _add_months(month_start, 1) <= cutoff]
+        # The legacy partition ends where the first monthly partition starts
+        if 'wallet_balance_history_legacy' in partitions and monthly and min(monthly.values()) <= cutoff:
+            expired.append('wallet_balance_history_legacy')
+
+        for name in expired:
+            cursor.execute(
+                sql.SQL("ALTER TABLE wallet_balance_history DETACH PARTITION {}").format(sql.Identifier(name))
+            )
+
+    return current_month
+
+def carry_forward_balances(cursor, month_start):
+    """
+    In delta mode a balance that hasn't changed in a while only has a history row in an old partition,
+    which retention detaches. Give every held balance unchanged since before month_start a
+    carried_forward row at month_start, so as-of lookups keep finding it. Safe to run repeatedly.
+    """
+    cursor.execute("""
+        INSERT INTO wallet_balance_history (wallet_address, token_address, timestamp, balance_raw, decimals, value_micro, carried_forward)
+        SELECT wallet_address, token_address, %(month_start)s, balance_raw, decimals, value_micro, TRUE
+        FROM wallet_balance_latest
+        WHERE updated_at < %(month_start)s
+        ON CONFLICT (wallet_address, token_address, timestamp) DO NOTHING;
+    """, {'month_start': month_start})
+    metrics.inc('db_rows_written', cursor.rowcount, table='wallet_balance_history')
+
+def migrate_to_fixed_point(cursor, table):
+    """
+    Convert a table's NUMERIC balance and value columns to balance_raw/decimals/value_micro, if it still has them.
+    The token decimals weren't stored before, so existing rows keep the precision they were stored with
+    (capped to fit in NUMERIC(39, 0)), the next check writes the token's real decimals and the diff rescales between them.
+    Raw columns first created as BIGINT are widened.
+    """
+    cursor.execute("""
+        SELECT column_name, data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s
+    """, (table,))
+    column_types = dict(cursor.fetchall())
+    if column_types.get('balance_raw') == 'bigint':
+        cursor.execute(sql.SQL("""
+            ALTER TABLE {table}
+                ALTER COLUMN balance_raw TYPE NUMERIC(39, 0),
+                ALTER COLUMN value_micro TYPE NUMERIC(39, 0);
+        """).format(table=sql.Identifier(table)))
+    if 'balance' not in column_types:
+        return
+
+    cursor.execute(sql.SQL("""
+        ALTER TABLE {table}
+            ADD COLUMN balance_raw NUMERIC(39, 0),
+            ADD COLUMN decimals SMALLINT,
+            ADD COLUMN value_micro NUMERIC(39, 0);
+        UPDATE {table}
+        SET decimals = LEAST(scale(balance), GREATEST(0, 39 - length(trunc(abs(balance))::text))),
+            value_micro = ROUND(value * 1000000);
+        UPDATE {table}
+        SET balance_raw = ROUND(balance * power(10::numeric, decimals));
+        ALTER TABLE {table}
+            ALTER COLUMN balance_raw SET NOT NULL,
+            ALTER COLUMN decimals SET NOT NULL,
+            ALTER COLUMN value_micro SET NOT NULL,
+            DROP COLUMN balance,
+            DROP COLUMN value;
+    """).format(table=sql.Identifier(table)))
 
 def initialize_db():
     conn = get_db_connection()
@@ -25,14 +261,6 @@ def initialize_db():
             name VARCHAR(128),
             symbol VARCHAR(32)
         );
-        CREATE TABLE IF NOT EXISTS wallet_balance_history (
-            wallet_address VARCHAR(128) REFERENCES wallets(wallet_address),
-            token_address VARCHAR(128) REFERENCES tokens(token_address),
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            balance NUMERIC NOT NULL,
-            value NUMERIC NOT NULL,
-            PRIMARY KEY (wallet_address, token_address, timestamp)
-        );
         CREATE TABLE IF NOT EXISTS wallet_trades (
             tx_hash VARCHAR(128) PRIMARY KEY,
             wallet_address VARCHAR(128) REFERENCES wallets(wallet_address),
@@ -42,28 +270,172 @@ def initialize_db():
             volume NUMERIC NOT NULL,
             timestamp TIMESTAMP NOT NULL
         );
+        CREATE TABLE IF NOT EXISTS wallet_balance_latest (
+            wallet_address VARCHAR(128) REFERENCES wallets(wallet_address),
+            token_address VARCHAR(128) REFERENCES tokens(token_address),
+            balance_raw NUMERIC(39, 0) NOT NULL,
+            decimals SMALLINT NOT NULL,
+            value_micro NUMERIC(39, 0) NOT NULL,
+            updated_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (wallet_address, token_address)
+        );
+        CREATE TABLE IF NOT EXISTS wallet_checks (
+            wallet_address VARCHAR(128) PRIMARY KEY REFERENCES wallets(wallet_address),
+            checked_at TIMESTAMP NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS wallet_trade_cursors (
+            wallet_address VARCHAR(128) PRIMARY KEY REFERENCES wallets(wallet_address),
+            last_tx_hash VARCHAR(128) NOT NULL,
+            last_timestamp TIMESTAMP NOT NULL
+        );
+        DROP TABLE IF EXISTS token_metadata;
+        CREATE TABLE IF NOT EXISTS registry_version (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            version BIGINT NOT NULL
+        );
+        INSERT INTO registry_version (id, version) VALUES (TRUE, 0) ON CONFLICT (id) DO NOTHING;
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id BIGSERIAL PRIMARY KEY,
+            channel VARCHAR(32) NOT NULL,
+            payload JSONB NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            last_error TEXT,
+            delivered_at TIMESTAMP
+        );
+        ALTER TABLE notification_outbox ADD COLUMN IF NOT EXISTS run_id BIGINT;
+        CREATE INDEX IF NOT EXISTS notification_outbox_pending_idx
+            ON notification_outbox (channel, next_attempt_at) WHERE delivered_at IS NULL;
+        CREATE TABLE IF NOT EXISTS balance_runs (
+            id BIGSERIAL PRIMARY KEY,
+            started_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        );
+        ALTER TABLE balance_runs ADD COLUMN IF NOT EXISTS pages_sent INTEGER NOT NULL DEFAULT 0;
+        ALTER TABLE balance_runs ADD COLUMN IF NOT EXISTS previous_check_time TIMESTAMP;
+        CREATE TABLE IF NOT EXISTS balance_run_wallets (
+            run_id BIGINT REFERENCES balance_runs(id) ON DELETE CASCADE,
+            wallet_address VARCHAR(128) REFERENCES wallets(wallet_address),
+            completed_at TIMESTAMP,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            PRIMARY KEY (run_id, wallet_address)
+        );
+    """)
+    for table in ('wallet_balance_latest', 'wallet_balance_history'):
+        migrate_to_fixed_point(cursor, table)
+    create_history_table(cursor)
+
+    # Start trade cursors from the newest stored trade per wallet
+    cursor.execute("""
+        INSERT INTO wallet_trade_cursors (wallet_address, last_tx_hash, last_timestamp)
+        SELECT DISTINCT ON (wallet_address) wallet_address, tx_hash, timestamp
+        FROM wallet_trades
+        WHERE wallet_address IS NOT NULL
+        ORDER BY wallet_address, timestamp DESC
+        ON CONFLICT (wallet_address) DO NOTHING;
+    """)
+
+    # Seed the latest snapshot from history the first time it is created
+    cursor.execute("""
+        WITH latest_timestamp AS (
+            SELECT MAX(timestamp) as max_ts
+            FROM wallet_balance_history
+        ),
+        seeded AS (
+            INSERT INTO wallet_balance_latest (wallet_address, token_address, balance_raw, decimals, value_micro, updated_at)
+            SELECT wbh.wallet_address, wbh.token_address, wbh.balance_raw, wbh.decimals, wbh.value_micro, wbh.timestamp
+            FROM wallet_balance_history wbh
+            WHERE wbh.timestamp = (SELECT max_ts FROM latest_timestamp)
+            AND NOT EXISTS (SELECT 1 FROM wallet_balance_latest)
+            RETURNING 1
+        )
+        INSERT INTO wallet_checks (wallet_address, checked_at)
+        SELECT w.wallet_address, (SELECT max_ts FROM latest_timestamp)
+        FROM wallets w
+        WHERE (SELECT max_ts FROM latest_timestamp) IS NOT NULL
+        AND NOT EXISTS (SELECT 1 FROM wallet_checks)
+        ON CONFLICT (wallet_address) DO NOTHING;
     """)
     conn.commit()
     cursor.close()
     conn.close()
 
+def bump_registry_version(cursor):
+    """
+    Increment the registry version and notify listeners, both take effect on commit
+    """
+    cursor.execute("""
+        UPDATE registry_version SET version = version + 1
+        RETURNING version;
+    """)
+    version = cursor.fetchone()
+    version = version['version'] if isinstance(version, dict) else version[0]
+    cursor.execute("SELECT pg_notify('registry_changed', %s);", (str(version),))
+
+async def get_registry_version():
+    def query(cursor):
+        cursor.execute("SELECT version FROM registry_version;")
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    return await run_query(query)
+
+async def listen_registry_changes(callback):
+    """
+    LISTEN for registry_changed notifications on a dedicated connection.
+    callback(payload) is called from the event loop for each notification, and callback(None)
+    if the connection is lost.
+    """
+    global _registry_listener
+    if is_listening_for_registry_changes():
+        return
+
+    loop = asyncio.get_running_loop()
+    conn = await asyncio.to_thread(get_db_connection)
+    conn.set_session(autocommit=True)
+    with conn.cursor() as cursor:
+        cursor.execute("LISTEN registry_changed;")
+    fd = conn.fileno()
+
+    def on_readable():
+        global _registry_listener
+        try:
+            conn.poll()
+        except psycopg2.Error:
+            loop.remove_reader(fd)
+            conn.close()
+            _registry_listener = None
+            callback(None)
+            return
+        while conn.notifies:
+            callback(conn.notifies.pop(0).payload)
+
+    loop.add_reader(fd, on_readable)
+    _registry_listener = conn
+
+def is_listening_for_registry_changes():
+    return _registry_listener is not None and not _registry_listener.closed
+
 async def upsert_wallets(wallets):
     """
     Upsert wallets
     wallets: list of tuples (wallet_address, alias)
     """
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
-    # First, try to insert and get successful inserts
-    execute_values(cursor, """
-        INSERT INTO wallets (wallet_address, alias)
-        VALUES %s
-        ON CONFLICT (wallet_address) DO NOTHING
-        RETURNING wallet_address, alias;
-    """, wallets)
-    
-    upserted = cursor.fetchall()
+    def query(cursor):
+        # First, try to insert and get successful inserts
+        upserted = execute_values(cursor, """
+            INSERT INTO wallets (wallet_address, alias)
+            VALUES %s
+            ON CONFLICT (wallet_address) DO NOTHING
+            RETURNING wallet_address, alias;
+        """, wallets, fetch=True)
+        if upserted:
+            bump_registry_version(cursor)
+        return upserted
+
+    upserted = await run_query(query, cursor_factory=RealDictCursor)
     
     # Find which ones weren't inserted (conflicts)
     upserted_wallets = [row['wallet_address'] for row in upserted]
@@ -73,10 +445,6 @@ async def upsert_wallets(wallets):
         if addr not in upserted_wallets
     ]
     
-    conn.commit()
-    cursor.close()
-    conn.close()
-    
     return {
         'upserted': upserted,
         'conflicts': conflicts
@@ -87,15 +455,18 @@ async def upsert_tokens(tokens):
     Upsert tokens
     tokens: list of tuples (token_address, name, symbol)
     """
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    execute_values(cursor, """
-        INSERT INTO tokens (token_address, name, symbol)
-        VALUES %s
-        ON CONFLICT (token_address) DO NOTHING
-        RETURNING token_address, name, symbol;
-    """, tokens)
-    upserted = cursor.fetchall()
+    def query(cursor):
+        upserted = execute_values(cursor, """
+            INSERT INTO tokens (token_address, name, symbol)
+            VALUES %s
+            ON CONFLICT (token_address) DO NOTHING
+            RETURNING token_address, name, symbol;
+        """, tokens, fetch=True)
+        if upserted:
+            bump_registry_version(cursor)
+        return upserted
+
+    upserted = await run_query(query, cursor_factory=RealDictCursor)
 
     upserted_tokens = [row['token_address'] for row in upserted]
     conflicts = [
@@ -103,112 +474,472 @@ async def upsert_tokens(tokens):
         for addr, name, symbol in tokens
         if addr not in upserted_tokens
     ]
-    conn.commit()
-    cursor.close()
-    conn.close()
 
     return {
         'upserted': upserted,
         'conflicts': conflicts
     }
 
-async def upsert_wallet_balances(wallet_balances):
+def insert_notifications(cursor, notifications, run_id=None):
     """
-    Upsert wallet balances
-    wallet_balances: list of tuples (wallet_address, token_address, balance, value)
+    Queue notifications in the outbox, they are only visible to the delivery worker once the transaction commits
+    notifications: list of tuples (channel, payload), payload is anything json serializable
+    (decimals and datetimes are stored as strings)
+    run_id: optional balance run the notifications belong to, its pages are numbered across deliveries
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    if not notifications:
+        return
     execute_values(cursor, """
-        INSERT INTO wallet_balance_history (wallet_address, token_address, balance, value)
+        INSERT INTO notification_outbox (channel, payload, run_id)
         VALUES %s
-    """, wallet_balances)
-    conn.commit()
-    cursor.close()
-    conn.close()
+    """, [(channel, Json(payload, dumps=_dumps_payload), run_id) for channel, payload in notifications])
+    metrics.inc('db_rows_written', len(notifications), table='notification_outbox')
+
+def _dumps_payload(payload):
+    return json.dumps(payload, default=str)
+
+async def enqueue_notifications(notifications):
+    """
+    Queue notifications in the outbox on their own
+    notifications: list of tuples (channel, payload)
+    """
+    def query(cursor):
+        insert_notifications(cursor, notifications)
+
+    await run_query(query)
+
+async def claim_notifications(channel, limit, lease_seconds, max_attempts):
+    """
+    Claim up to limit pending notifications for a channel, oldest first.
+    A balance run's summary is only claimed once the run's other notifications were delivered (or gave up),
+    rows come with the pages already sent for their run.
+    Claimed rows are hidden from other workers for lease_seconds, so a worker that dies mid delivery
+    only delays them. Rows that failed max_attempts times are left for inspection.
+    """
+    def query(cursor):
+        cursor.execute("""
+            UPDATE notification_outbox
+            SET next_attempt_at = LOCALTIMESTAMP + %(lease_seconds)s * INTERVAL '1 second'
+            WHERE id IN (
+                SELECT o.id
+                FROM notification_outbox o
+                WHERE o.channel = %(channel)s
+                AND o.delivered_at IS NULL
+                AND o.next_attempt_at <= LOCALTIMESTAMP
+                AND o.attempts < %(max_attempts)s
+                AND NOT (o.payload ? 'summary' AND EXISTS (
+                    SELECT 1 FROM notification_outbox pending
+                    WHERE pending.run_id = o.run_id
+                    AND pending.id < o.id
+                    AND pending.delivered_at IS NULL
+                    AND pending.attempts < %(max_attempts)s
+                ))
+                ORDER BY o.id
+                LIMIT %(limit)s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, channel, payload, attempts, run_id,
+                (SELECT pages_sent FROM balance_runs r WHERE r.id = notification_outbox.run_id) AS pages_sent;
+        """, {'channel': channel, 'limit': limit, 'lease_seconds': lease_seconds, 'max_attempts': max_attempts})
+        return sorted(cursor.fetchall(), key=lambda row: row['id'])
+
+    return await run_query(query, cursor_factory=RealDictCursor)
 
-async def upsert_wallet_trades(wallet_trades):
+async def get_balance_run_changes(run_id, channel):
+    """
+    The balance change payloads queued for a run, for its summary
+    """
+    def query(cursor):
+        cursor.execute("""
+            SELECT payload FROM notification_outbox
+            WHERE run_id = %s AND channel = %s AND payload ? 'change'
+            ORDER BY id;
+        """, (run_id, channel))
+        return [payload for (payload,) in cursor.fetchall()]
+
+    return await run_query(query)
+
+async def add_balance_run_pages(run_id, pages):
+    def query(cursor):
+        cursor.execute("UPDATE balance_runs SET pages_sent = pages_sent + %s WHERE id = %s;", (pages, run_id))
+
+    await run_query(query)
+
+async def mark_notifications_delivered(ids):
+    def query(cursor):
+        cursor.execute("""
+            UPDATE notification_outbox
+            SET delivered_at = LOCALTIMESTAMP, last_error = NULL
+            WHERE id = ANY(%s);
+        """, (list(ids),))
+
+    await run_query(query)
+
+async def mark_notifications_failed(ids, error, base_backoff_seconds, max_backoff_seconds):
+    """
+    Record a failed delivery and schedule a retry with exponential backoff
+    """
+    def query(cursor):
+        cursor.execute("""
+            UPDATE notification_outbox
+            SET attempts = attempts + 1,
+                last_error = %(error)s,
+                next_attempt_at = LOCALTIMESTAMP + LEAST(
+                    %(max_backoff_seconds)s, %(base_backoff_seconds)s * POWER(2, attempts)
+                ) * INTERVAL '1 second'
+            WHERE id = ANY(%(ids)s);
+        """, {
+            'ids': list(ids),
+            'error': error,
+            'base_backoff_seconds': base_backoff_seconds,
+            'max_backoff_seconds': max_backoff_seconds,
+        })
+
+    await run_query(query)
+
+async def start_balance_run(wallet_addresses, resume_within_hours, keep_days=30):
+    """
+    Resume the newest unfinished balance run started within resume_within_hours, or start a new one
+    journaling wallet_addresses. Older unfinished runs are closed, finished runs older than keep_days are deleted.
+    Assumes the unfinished run is no longer going, i.e. runs don't overlap.
+    A new run records when balances were last checked before it started, a resumed run keeps that
+    time rather than one its own finished wallets have already moved on.
+    Returns a tuple of (run_id, wallet addresses not yet completed in the run, previous check time)
     """
-    Upsert wallet trades
+    def query(cursor):
+        cursor.execute("""
+            SELECT id, previous_check_time FROM balance_runs
+            WHERE finished_at IS NULL
+            AND started_at >= LOCALTIMESTAMP - %s * INTERVAL '1 hour'
+            ORDER BY id DESC
+            LIMIT 1;
+        """, (resume_within_hours,))
+        run_id, previous_check_time = cursor.fetchone() or (None, None)
+
+        cursor.execute("""
+            UPDATE balance_runs SET finished_at = LOCALTIMESTAMP
+            WHERE finished_at IS NULL AND id IS DISTINCT FROM %s;
+
+            DELETE FROM balance_runs WHERE finished_at < LOCALTIMESTAMP - %s * INTERVAL '1 day';
+        """, (run_id, keep_days))
+
+        if run_id is not None:
+            cursor.execute("""
+                SELECT wallet_address FROM balance_run_wallets
+                WHERE run_id = %s AND completed_at IS NULL;
+            """, (run_id,))
+            return run_id, [wallet_address for (wallet_address,) in cursor.fetchall()], previous_check_time
+
+        cursor.execute("""
+            INSERT INTO balance_runs (previous_check_time)
+            SELECT MAX(checked_at) FROM wallet_checks
+            RETURNING id, previous_check_time;
+        """)
+        run_id, previous_check_time = cursor.fetchone()
+        if wallet_addresses:
+            execute_values(cursor, """
+                INSERT INTO balance_run_wallets (run_id, wallet_address)
+                VALUES %s
+            """, [(run_id, wallet_address) for wallet_address in wallet_addresses])
+        return run_id, list(wallet_addresses), previous_check_time
+
+    return await run_query(query)
+
+async def record_balance_run_failure(run_id, wallet_address, error):
+    def query(cursor):
+        cursor.execute("""
+            UPDATE balance_run_wallets
+            SET attempts = attempts + 1, last_error = %s
+            WHERE run_id = %s AND wallet_address = %s;
+        """, (error, run_id, wallet_address))
+
+    await run_query(query)
+
+async def finish_balance_run(run_id, notification_channel=None):
+    """
+    Close the run, and if notification_channel is set and the run queued changes on it,
+    queue the run's summary, delivered once all its changes are
+    """
+    def query(cursor):
+        cursor.execute("UPDATE balance_runs SET finished_at = LOCALTIMESTAMP WHERE id = %s;", (run_id,))
+        if notification_channel:
+            cursor.execute("""
+                INSERT INTO notification_outbox (channel, payload, run_id)
+                SELECT %(channel)s, jsonb_build_object('summary', TRUE), %(run_id)s
+                WHERE EXISTS (
+                    SELECT 1 FROM notification_outbox
+                    WHERE run_id = %(run_id)s AND channel = %(channel)s AND payload ? 'change'
+                );
+            """, {'channel': notification_channel, 'run_id': run_id})
+
+    await run_query(query)
+
+async def upsert_wallet_balances(wallet_balances, wallet_addresses=None, notifications=None, run_id=None):
+    """
+    Upsert wallet balances
+    wallet_balances: list of tuples (wallet_address, token_address, balance_raw, decimals, value_micro)
+    wallet_addresses: wallets covered by this check, defaults to the wallets in wallet_balances.
+    Their tokens missing from wallet_balances are no longer held, they get a 0 history row and
+    are removed from the latest snapshot.
+    notifications: optional list of tuples (channel, payload) queued in the outbox in the same transaction
+    run_id: optional balance run the wallets are marked completed in, in the same transaction
+
+    With BALANCE_HISTORY_MODE=delta (the default) history only gets a row when a balance changed,
+    with snapshot every balance is written on every check.
+    """
+    if wallet_addresses is None:
+        wallet_addresses = list({balance[0] for balance in wallet_balances})
+
+    global _history_partitions_checked_on
+    today = datetime.date.today()
+
+    def query(cursor):
+        # Long running processes roll partitions forward as the months pass
+        if _history_partitions_checked_on != today:
+            maintain_history_partitions(cursor)
+
+        cursor.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS wallet_balance_batch (
+                wallet_address VARCHAR(128),
+                token_address VARCHAR(128),
+                balance_raw NUMERIC(39, 0) NOT NULL,
+                decimals SMALLINT NOT NULL,
+                value_micro NUMERIC(39, 0) NOT NULL,
+                PRIMARY KEY (wallet_address, token_address)
+            ) ON COMMIT DELETE ROWS;
+        """)
+        execute_values(cursor, """
+            INSERT INTO wallet_balance_batch (wallet_address, token_address, balance_raw, decimals, value_micro)
+            VALUES %s
+        """, wallet_balances)
+
+        # CURRENT_TIMESTAMP is fixed for the transaction, so every row written here shares it.
+        # Balances stored at different decimals are compared by cross multiplying, which is exact in NUMERIC.
+        cursor.execute("""
+            INSERT INTO wallet_balance_history (wallet_address, token_address, balance_raw, decimals, value_micro)
+            SELECT b.wallet_address, b.token_address, b.balance_raw, b.decimals, b.value_micro
+            FROM wallet_balance_batch b
+            LEFT JOIN wallet_balance_latest wbl
+                ON wbl.wallet_address = b.wallet_address
+                AND wbl.token_address = b.token_address
+            WHERE %(snapshot)s
+            OR wbl.balance_raw::numeric * power(10::numeric, b.decimals)
+                IS DISTINCT FROM b.balance_raw::numeric * power(10::numeric, wbl.decimals)
+            UNION ALL
+            SELECT wbl.wallet_address, wbl.token_address, 0, wbl.decimals, 0
+            FROM wallet_balance_latest wbl
+            WHERE wbl.wallet_address = ANY(%(wallet_addresses)s)
+            AND NOT EXISTS (
+                SELECT 1 FROM wallet_balance_batch b
+                WHERE b.wallet_address = wbl.wallet_address
+                AND b.token_address = wbl.token_address
+            );
+        """, {'snapshot': BALANCE_HISTORY_MODE == 'snapshot', 'wallet_addresses': wallet_addresses})
+        metrics.inc('db_rows_written', cursor.rowcount, table='wallet_balance_history')
+
+        # updated_at records when the balance last changed
+        cursor.execute("""
+            INSERT INTO wallet_balance_latest (wallet_address, token_address, balance_raw, decimals, value_micro, updated_at)
+            SELECT wallet_address, token_address, balance_raw, decimals, value_micro, CURRENT_TIMESTAMP
+            FROM wallet_balance_batch
+            ON CONFLICT (wallet_address, token_address) DO UPDATE
+            SET balance_raw = EXCLUDED.balance_raw,
+                decimals = EXCLUDED.decimals,
+                value_micro = EXCLUDED.value_micro,
+                updated_at = CASE
+                    WHEN wallet_balance_latest.balance_raw::numeric * power(10::numeric, EXCLUDED.decimals)
+                        <> EXCLUDED.balance_raw::numeric * power(10::numeric, wallet_balance_latest.decimals)
+                    THEN EXCLUDED.updated_at
+                    ELSE wallet_balance_latest.updated_at
+                END;
+
+            DELETE FROM wallet_balance_latest wbl
+            WHERE wbl.wallet_address = ANY(%(wallet_addresses)s)
+            AND NOT EXISTS (
+                SELECT 1 FROM wallet_balance_batch b
+                WHERE b.wallet_address = wbl.wallet_address
+                AND b.token_address = wbl.token_address
+            );
+        """, {'wallet_addresses': wallet_addresses})
+
+        if wallet_addresses:
+            execute_values(cursor, """
+                INSERT INTO wallet_checks (wallet_address, checked_at)
+                VALUES %s
+                ON CONFLICT (wallet_address) DO UPDATE
+                SET checked_at = EXCLUDED.checked_at
+            """, [(address,) for address in wallet_addresses], template='(%s, CURRENT_TIMESTAMP)')
+
+        insert_notifications(cursor, notifications, run_id)
+
+        if run_id is not None:
+            cursor.execute("""
+                UPDATE balance_run_wallets SET completed_at = CURRENT_TIMESTAMP
+                WHERE run_id = %s AND wallet_address = ANY(%s);
+            """, (run_id, wallet_addresses))
+
+    await run_query(query)
+    metrics.inc('db_rows_written', len(wallet_balances), table='wallet_balance_latest')
+    _history_partitions_checked_on = today
+
+async def upsert_wallet_trades(wallet_trades, notification_channel=None):
+    """
+    Upsert wallet trades, skipping ones already stored
     wallet_trades: list of tuples (tx_hash, wallet_address, from_token, to_token, price, volume, timestamp)
+    notification_channel: if set, each new trade is queued in the outbox on this channel in the same transaction
+    Returns the rows that were newly inserted
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_values(cursor, """
-        INSERT INTO wallet_trades (tx_hash, wallet_address, from_token, to_token, price, volume, timestamp)
-        VALUES %s
-    """, wallet_trades)
-    conn.commit()
-    cursor.close()
-    conn.close()
+    def query(cursor):
+        inserted = execute_values(cursor, """
+            INSERT INTO wallet_trades (tx_hash, wallet_address, from_token, to_token, price, volume, timestamp)
+            VALUES %s
+            ON CONFLICT (tx_hash) DO NOTHING
+            RETURNING tx_hash, wallet_address, from_token, to_token, price, volume, timestamp;
+        """, wallet_trades, fetch=True)
+        if notification_channel:
+            insert_notifications(cursor, [(notification_channel, dict(trade)) for trade in inserted])
+        metrics.inc('db_rows_written', len(inserted), table='wallet_trades')
+        return inserted
+
+    return await run_query(query, cursor_factory=RealDictCursor)
+
+async def upsert_wallet_trade_cursors(trade_cursors):
+    """
+    Upsert the newest trade seen per wallet, never moving a cursor backwards
+    trade_cursors: list of tuples (wallet_address, last_tx_hash, last_timestamp)
+    """
+    def query(cursor):
+        execute_values(cursor, """
+            INSERT INTO wallet_trade_cursors (wallet_address, last_tx_hash, last_timestamp)
+            VALUES %s
+            ON CONFLICT (wallet_address) DO UPDATE
+            SET last_tx_hash = EXCLUDED.last_tx_hash, last_timestamp = EXCLUDED.last_timestamp
+            WHERE wallet_trade_cursors.last_timestamp <= EXCLUDED.last_timestamp
+        """, trade_cursors)
+
+    await run_query(query)
+
+async def get_wallet_trade_cursors():
+    def query(cursor):
+        cursor.execute("SELECT * FROM wallet_trade_cursors;")
+        return cursor.fetchall()
+
+    return await run_query(query, cursor_factory=RealDictCursor)
 
 async def get_all_wallets():
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("SELECT * FROM wallets;")
-    wallets = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return wallets
+    def query(cursor):
+        cursor.execute("SELECT * FROM wallets;")
+        return cursor.fetchall()
+
+    return await run_query(query, cursor_factory=RealDictCursor)
 
 async def get_all_tokens():
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("SELECT * FROM tokens;")
-    tokens = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return tokens
+    def query(cursor):
+        cursor.execute("SELECT * FROM tokens;")
+        return cursor.fetchall()
 
-async def get_previous_wallet_balance():
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("""
-        WITH latest_timestamp AS (
-            SELECT MAX(timestamp) as max_ts
-            FROM wallet_balance_history
-        )
-        SELECT 
-            w.wallet_address,
-            t.token_address,
-            (SELECT max_ts FROM latest_timestamp) as previous_check_time,
-            COALESCE(
-                (SELECT balance
-                 FROM wallet_balance_history wbh
-                 WHERE wbh.wallet_address = w.wallet_address 
-                 AND wbh.token_address = t.token_address
-                 AND wbh.timestamp = (SELECT max_ts FROM latest_timestamp)
-                ),
-                0
-            ) as balance,
-            COALESCE(
-                (SELECT value
-                 FROM wallet_balance_history wbh
-                 WHERE wbh.wallet_address = w.wallet_address 
-                 AND wbh.token_address = t.token_address
-                 AND wbh.timestamp = (SELECT max_ts FROM latest_timestamp)
-                ),
-                0
-            ) as value
-        FROM wallets w
-        CROSS JOIN tokens t
-    """)
-    results = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return results
+    return await run_query(query, cursor_factory=RealDictCursor)
 
-async def get_previous_wallet_trades():
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("""
-        SELECT * FROM wallet_trades;
-    """)
-    results = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return results
+async def get_previous_wallet_balance(wallet_addresses=None):
+    """
+    Get the latest stored balances, optionally only for the given wallets.
+    Only held tokens are returned, anything missing has a 0 balance.
+    """
+    def query(cursor):
+        if wallet_addresses is None:
+            cursor.execute("SELECT wallet_address, token_address, balance_raw, decimals, value_micro FROM wallet_balance_latest;")
+        else:
+            cursor.execute("""
+                SELECT wallet_address, token_address, balance_raw, decimals, value_micro
+                FROM wallet_balance_latest
+                WHERE wallet_address = ANY(%s);
+            """, (list(wallet_addresses),))
+        return cursor.fetchall()
+
+    rows = await run_query(query, cursor_factory=RealDictCursor)
+    metrics.inc('db_rows_read', len(rows), table='wallet_balance_latest')
+    return rows
+
+async def get_wallet_balances_as_of(timestamp, wallet_addresses=None):
+    """
+    Get the balances held at a point in time, from the latest history row at or before it per (wallet, token).
+    Works with both history modes since tokens that are sold out get a 0 row, and with retention
+    since held balances are carried forward into each month.
+    """
+    def query(cursor):
+        cursor.execute("""
+            SELECT wallet_address, token_address, timestamp, balance_raw, decimals, value_micro
+            FROM (
+                SELECT DISTINCT ON (wallet_address, token_address)
+                    wallet_address, token_address, timestamp, balance_raw, decimals, value_micro
+                FROM wallet_balance_history
+                WHERE timestamp <= %(timestamp)s
+                AND (%(all_wallets)s OR wallet_address = ANY(%(wallet_addresses)s))
+                ORDER BY wallet_address, token_address, timestamp DESC
+            ) as_of
+            WHERE balance_raw <> 0;
+        """, {
+            'timestamp': timestamp,
+            'all_wallets': wallet_addresses is None,
+            'wallet_addresses': list(wallet_addresses or []),
+        })
+        return cursor.fetchall()
+
+    return await run_query(query, cursor_factory=RealDictCursor)
+
+async def get_wallet_activity(window_days):
+    """
+    Per wallet: when it was last checked, when a balance last changed within the last window_days
+    (from wallet_balance_history), how many changes there were and its total value
+    """
+    def query(cursor):
+        cursor.execute("""
+            WITH history AS (
+                SELECT
+                    wallet_address,
+                    timestamp,
+                    carried_forward,
+                    balance_raw / power(10::numeric, decimals) AS balance,
+                    LAG(balance_raw / power(10::numeric, decimals)) OVER (PARTITION BY wallet_address, token_address ORDER BY timestamp) AS previous_balance
+                FROM wallet_balance_history
+                WHERE timestamp >= LOCALTIMESTAMP - %(window_days)s * INTERVAL '1 day'
+            ),
+            changes AS (
+                SELECT wallet_address, MAX(timestamp) AS last_change_at, COUNT(*) AS change_count
+                FROM history
+                -- In delta mode every row is a change, in snapshot mode compare with the previous row.
+                -- Carried forward rows only repeat a balance.
+                WHERE NOT carried_forward
+                AND (%(delta)s OR (previous_balance IS NOT NULL AND previous_balance <> balance))
+                GROUP BY wallet_address
+            ),
+            holdings AS (
+                SELECT wallet_address, SUM(value_micro) / 1000000.0 AS total_value
+                FROM wallet_balance_latest
+                GROUP BY wallet_address
+            )
+            SELECT
+                w.wallet_address,
+                wc.checked_at,
+                c.last_change_at,
+                COALESCE(c.change_count, 0) AS change_count,
+                COALESCE(h.total_value, 0) AS total_value,
+                LOCALTIMESTAMP AS now
+            FROM wallets w
+            LEFT JOIN wallet_checks wc ON wc.wallet_address = w.wallet_address
+            LEFT JOIN changes c ON c.wallet_address = w.wallet_address
+            LEFT JOIN holdings h ON h.wallet_address = w.wallet_address;
+        """, {'window_days': window_days, 'delta': BALANCE_HISTORY_MODE != 'snapshot'})
+        return cursor.fetchall()
+
+    return await run_query(query, cursor_factory=RealDictCursor)
+
+async def get_previous_check_time():
+    def query(cursor):
+        cursor.execute("SELECT MAX(checked_at) FROM wallet_checks;")
+        return cursor.fetchone()[0]
+
+    return await run_query(query)
 
 if __name__ == "__main__":
     initialize_db()
-
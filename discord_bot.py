@@ -9,20 +9,24 @@ from discord.ext import commands
 from functools import wraps
 
 from wallet_tracker import (
-    check_wallet_balances, 
+    balance_run_lock,
+    stream_wallet_balances,
+    get_previous_check_time_text,
     list_wallets, 
     list_tokens, 
     add_wallets, 
     add_tokens,
-    initialize,
-)
-from utils import (
-    create_wallet_balance_change_embed,
-    create_token_flow_summary_embed,
+    refresh_registry,
+    watch_registry,
 )
+from utils import MESSAGE_MAX_CONTENT_CHARS, BalanceChangePublisher, StatusReporter
+from db import init_db_pool
+from metrics import METRICS_HOST, METRICS_PORT, start_metrics_server
+from scheduler import start_scheduler
 from multiLineModal import MultiLineModal
 
 DISCORD_BOT_TOKEN = os.environ['DISCORD_BOT_TOKEN']
+SCHEDULER_ENABLED = os.getenv('SCHEDULER_ENABLED', 'false').lower() in ('1', 'true', 'yes')
 intents = discord.Intents.default()
 intents.message_content = True  # May not be necessary for slash commands
 
@@ -78,8 +82,8 @@ def refresh_state():
             try:
                 # Defer first
                 await interaction.response.defer()
-                # Then refresh state
-                await initialize()
+                # Then refresh state, only reloads if the registry changed
+                await refresh_registry()
                 return await func(interaction, *args, **kwargs)
             except Exception as e:
                 print(f"Error in refresh_state: {str(e)}")
@@ -116,33 +120,33 @@ def validate_addresses():
 @tree.command(name="check_wallet_balances", description="Check all wallet balances")
 @refresh_state()
 async def check_wallet_balances_command(interaction: discord.Interaction):
-    status_message = await interaction.followup.send('Starting wallet balance check...', wait=True)
-    
-    async def update_status(message: str):
-        await status_message.edit(content=message)
-    
-    changes, previous_check_time = await check_wallet_balances(status_callback=update_status)
-    if len(changes) == 0:
-        await status_message.edit(content="No significant balance changes")
+    if balance_run_lock.locked():
+        await interaction.followup.send('A wallet balance check is already running, try again once it finishes')
         return
 
-    CHANGES_PER_EMBED = 20
-    batches = [changes[i:i + CHANGES_PER_EMBED] 
-              for i in range(0, len(changes), CHANGES_PER_EMBED)]
-    total_pages = len(batches)
+    status_message = await interaction.followup.send('Starting wallet balance check...', wait=True)
 
-    # Send first embed by editing the status message
-    first_embed = create_wallet_balance_change_embed(batches[0], previous_check_time, 1, total_pages)
-    await status_message.edit(content=None, embed=first_embed)
-    
-    # Send additional embeds as new messages
-    for page, batch in enumerate(batches[1:], 2):
-        embed = create_wallet_balance_change_embed(batch, None, page, total_pages)
-        await interaction.followup.send(embed=embed)
-    
-    # Send summary embed as the final message
-    summary_embed = create_token_flow_summary_embed(changes)
-    await interaction.followup.send(embed=summary_embed)
+    # Progress edits are coalesced and sent in the background so the check never waits on Discord
+    status_reporter = StatusReporter(status_message.edit)
+
+    # Send each page of changes as soon as it fills up instead of after the whole check
+    publisher = BalanceChangePublisher(interaction.followup.send, await get_previous_check_time_text())
+    failed = []
+    try:
+        async for result in stream_wallet_balances(status_callback=status_reporter.update):
+            if result.error:
+                failed.append(result.wallet['alias'])
+            await publisher.add(result.changes)
+    finally:
+        await status_reporter.close()
+
+    if await publisher.close() == 0:
+        status = "No significant balance changes"
+    else:
+        status = "Wallet balance check complete"
+    if failed:
+        status += f"\nFailed to check {len(failed)} wallets: {', '.join(failed)}"
+    await status_message.edit(content=status[:MESSAGE_MAX_CONTENT_CHARS])
 
 @tree.command(name="list_wallets", description="List all wallets")
 @refresh_state()
@@ -286,6 +290,18 @@ async def bulk_add_tokens_command(interaction: discord.Interaction):
 @bot.event
 async def on_ready():
     print(f"Logged in as {bot.user}")
+    # Warm the connection pool before the first command arrives
+    await init_db_pool()
+    try:
+        await watch_registry()
+    except Exception as e:
+        print(f"Error listening for registry changes, falling back to version checks: {e}")
+    if SCHEDULER_ENABLED:
+        # Run the balance and trade checks in this process instead of the one-shot scripts
+        await start_scheduler()
+    if METRICS_PORT:
+        await start_metrics_server()
+        print(f"Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
     try:
         synced = await tree.sync()  # Sync commands with Discord
         print(f"Synced {len(synced)} command(s)")
@@ -0,0 +1,132 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+load_dotenv()
+
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PREFIX = 'wallet_tracker_'
+
+# (name, sorted label items) -> value, and -> [count, sum] for timers.
+# Db queries record from worker threads, so updates take the lock.
+_counters = defaultdict(float)
+_timers = defaultdict(lambda: [0, 0.0])
+_lock = threading.Lock()
+_server = None
+
+
+def _key(name, labels):
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+def inc(name: str, value: float = 1, **labels):
+    """
+    Add value to a counter
+    """
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] += value
+
+def observe(name: str, seconds: float, **labels):
+    """
+    Record one timing
+    """
+    key = _key(name, labels)
+    with _lock:
+        timer = _timers[key]
+        timer[0] += 1
+        timer[1] += seconds
+
+@contextmanager
+def timer(name: str, **labels):
+    """
+    Time the block, including when it raises
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (label, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for label, value in labels
+    )
+    return '{' + ','.join(f'{label}="{value}"' for label, value in escaped) + '}'
+
+def render() -> str:
+    """
+    Render all metrics in the Prometheus text format.
+    Counters become <name>_total, timers a summary of <name>_seconds_count and <name>_seconds_sum.
+    """
+    with _lock:
+        counters = sorted(_counters.items())
+        timers = sorted((key, tuple(value)) for key, value in _timers.items())
+
+    lines = []
+    typed = set()
+    for (name, labels), value in counters:
+        metric = f'{METRICS_PREFIX}{name}_total'
+        if metric not in typed:
+            lines.append(f'# TYPE {metric} counter')
+            typed.add(metric)
+        lines.append(f'{metric}{_format_labels(labels)} {value:g}')
+    for (name, labels), (count, total) in timers:
+        metric = f'{METRICS_PREFIX}{name}_seconds'
+        if metric not in typed:
+            lines.append(f'# TYPE {metric} summary')
+            typed.add(metric)
+        lines.append(f'{metric}_count{_format_labels(labels)} {count}')
+        lines.append(f'{metric}_sum{_format_labels(labels)} {total:.6f}')
+    return '\n'.join(lines) + '\n'
+
+def summary() -> dict:
+    """
+    All metrics as a flat dict, timers as {count, seconds}
+    """
+    with _lock:
+        result = {f'{name}{_format_labels(labels)}': value for (name, labels), value in sorted(_counters.items())}
+        result.update({
+            f'{name}{_format_labels(labels)}': {'count': count, 'seconds': round(total, 6)}
+            for (name, labels), (count, total) in sorted(_timers.items())
+        })
+    return result
+
+def log_summary(logger, run: str):
+    """
+    Log every metric as one structured line, for one-shot runs without a metrics endpoint
+    """
+    logger.info(json.dumps({'event': 'metrics', 'run': run, 'metrics': summary()}))
+
+async def _handle_metrics(request):
+    return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+async def start_metrics_server(port: int = METRICS_PORT, host: str = METRICS_HOST):
+    """
+    Serve /metrics on the running event loop, does nothing if port is 0 or the server is already running.
+    Returns the runner, or None if disabled.
+    """
+    global _server
+    if not port or _server is not None:
+        return _server
+    app = web.Application()
+    app.router.add_get('/metrics', _handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    _server = runner
+    return runner
@@ -0,0 +1,169 @@
+import asyncio
+import datetime
+import itertools
+import os
+
+import aiohttp
+from dotenv import load_dotenv
+from discord import Webhook
+
+import metrics
+from db import init_db_pool, close_db_pool, claim_notifications, mark_notifications_delivered, mark_notifications_failed, get_balance_run_changes, add_balance_run_pages
+from utils import BalanceChangePublisher, EMBED_MAX_FIELDS, create_wallet_trade_embed, logger
+from wallet_tracker import initialize, refresh_registry
+
+load_dotenv()
+
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 200))
+OUTBOX_POLL_SECONDS = float(os.getenv('OUTBOX_POLL_SECONDS', 15))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 10))
+OUTBOX_LEASE_SECONDS = 300
+OUTBOX_BASE_BACKOFF_SECONDS = 30
+OUTBOX_MAX_BACKOFF_SECONDS = 3600
+
+BALANCE_CHANGES_CHANNEL = 'wallet_balances'
+TRADES_CHANNEL = 'trades'
+
+# Each channel is delivered to the webhook in this env var
+CHANNEL_WEBHOOK_ENV = {
+    BALANCE_CHANGES_CHANNEL: 'DISCORD_WEBHOOK_WALLET_TRACKER_URL',
+    TRADES_CHANNEL: 'DISCORD_WEBHOOK_TRADES_URL',
+}
+
+
+def _change_from_payload(payload):
+    change = payload['change']
+    return {**change, **{
+        column: float(change[column])
+        for column in ('previous_balance', 'current_balance', 'balance_change', 'value_change')
+    }}
+
+def _balance_row_kind(row):
+    payload = row['payload']
+    if 'content' in payload:
+        return 'content'
+    if 'summary' in payload:
+        return 'summary'
+    return 'change'
+
+async def send_balance_changes(webhook: Webhook, rows):
+    """
+    Send queued balance changes as they come in. Pages of a balance run are numbered on from the ones
+    already sent, and the run's token flow summary is its own notification, queued when the run finishes.
+    Changes not from a run get their summary right away.
+    Payloads are {'change', 'previous_check_time'}, {'summary'} or {'content'} for plain messages.
+    """
+    pages_sent = {row['run_id']: row['pages_sent'] or 0 for row in rows if row['run_id'] is not None}
+    for (run_id, previous_check_time, kind), group in itertools.groupby(
+        rows, key=lambda row: (row['run_id'], row['payload'].get('previous_check_time'), _balance_row_kind(row))
+    ):
+        group = list(group)
+        if kind == 'content':
+            for row in group:
+                await webhook.send(content=row['payload']['content'])
+        elif kind == 'summary':
+            changes = await get_balance_run_changes(run_id, BALANCE_CHANGES_CHANNEL)
+            publisher = BalanceChangePublisher(webhook.send)
+            await publisher.add_summary([_change_from_payload(payload) for payload in changes])
+            await publisher.close(summary=False)
+        else:
+            first_page = pages_sent.get(run_id, 0) + 1
+            publisher = BalanceChangePublisher(
+                webhook.send,
+                previous_check_time,
+                max_delay_seconds=float('inf'),
+                first_page=first_page
+            )
+            await publisher.add([_change_from_payload(row['payload']) for row in group])
+            await publisher.close(summary=run_id is None)
+            if run_id is not None:
+                pages_sent[run_id] = publisher.page
+                await add_balance_run_pages(run_id, publisher.page - first_page + 1)
+
+async def send_trades(webhook: Webhook, rows):
+    trades = [
+        {
+            **row['payload'],
+            'price': float(row['payload']['price']),
+            'volume': float(row['payload']['volume']),
+            'timestamp': datetime.datetime.fromisoformat(row['payload']['timestamp']),
+        }
+        for row in rows
+    ]
+    for start in range(0, len(trades), EMBED_MAX_FIELDS):
+        with metrics.timer('discord_render', kind='trades'):
+            embed = create_wallet_trade_embed(trades[start:start + EMBED_MAX_FIELDS])
+        with metrics.timer('discord_send', kind='trades'):
+            await webhook.send(embed=embed)
+
+CHANNEL_SENDERS = {
+    BALANCE_CHANGES_CHANNEL: send_balance_changes,
+    TRADES_CHANNEL: send_trades,
+}
+
+async def deliver_pending(channel: str, webhook: Webhook) -> int:
+    """
+    Send the channel's pending notifications in batches of OUTBOX_BATCH_SIZE until none are left.
+    A failed batch is retried later with backoff, delivery is at least once so a batch that failed
+    halfway can be partly sent twice. Returns the number of notifications delivered.
+    """
+    delivered = 0
+    while True:
+        rows = await claim_notifications(channel, OUTBOX_BATCH_SIZE, OUTBOX_LEASE_SECONDS, OUTBOX_MAX_ATTEMPTS)
+        if not rows:
+            return delivered
+
+        ids = [row['id'] for row in rows]
+        try:
+            await CHANNEL_SENDERS[channel](webhook, rows)
+        except Exception as e:
+            logger.warning(f'Failed to deliver {len(rows)} {channel} notifications, will retry: {e}')
+            await mark_notifications_failed(ids, str(e), OUTBOX_BASE_BACKOFF_SECONDS, OUTBOX_MAX_BACKOFF_SECONDS)
+            metrics.inc('notifications_failed', len(rows), channel=channel)
+            return delivered
+
+        await mark_notifications_delivered(ids)
+        metrics.inc('notifications_delivered', len(rows), channel=channel)
+        delivered += len(rows)
+
+def create_webhooks(session: aiohttp.ClientSession) -> dict[str, Webhook]:
+    """
+    Webhooks by channel, for the channels with a webhook url configured
+    """
+    return {
+        channel: Webhook.from_url(os.environ[env_var], session=session)
+        for channel, env_var in CHANNEL_WEBHOOK_ENV.items()
+        if os.getenv(env_var)
+    }
+
+async def deliver_all_pending(webhooks: dict[str, Webhook]) -> int:
+    delivered = 0
+    for channel, webhook in webhooks.items():
+        delivered += await deliver_pending(channel, webhook)
+    return delivered
+
+async def run_delivery_worker():
+    """
+    Run the delivery worker on its own, polling the outbox every OUTBOX_POLL_SECONDS
+    """
+    # Rendering needs the wallet aliases and token symbols
+    await initialize()
+    async with aiohttp.ClientSession() as session:
+        webhooks = create_webhooks(session)
+        while True:
+            await refresh_registry()
+            delivered = await deliver_all_pending(webhooks)
+            if delivered:
+                logger.info(f'Delivered {delivered} notifications')
+            await asyncio.sleep(OUTBOX_POLL_SECONDS)
+
+async def main():
+    await init_db_pool()
+    await metrics.start_metrics_server()
+    try:
+        await run_delivery_worker()
+    finally:
+        await close_db_pool()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,53 @@
+import datetime
+import math
+import os
+
+from dotenv import load_dotenv
+
+from db import get_wallet_activity
+
+load_dotenv()
+
+ADAPTIVE_POLLING = os.getenv('ADAPTIVE_POLLING', 'false').lower() in ('1', 'true', 'yes')
+POLL_MIN_INTERVAL_MINUTES = float(os.getenv('POLL_MIN_INTERVAL_MINUTES', 15))
+POLL_MAX_INTERVAL_MINUTES = float(os.getenv('POLL_MAX_INTERVAL_MINUTES', 24 * 60))
+POLL_IDLE_FACTOR = float(os.getenv('POLL_IDLE_FACTOR', 0.25))
+POLL_HIGH_VALUE_USD = float(os.getenv('POLL_HIGH_VALUE_USD', 100_000))
+POLL_ACTIVITY_WINDOW_DAYS = int(os.getenv('POLL_ACTIVITY_WINDOW_DAYS', 30))
+
+
+def poll_interval(last_change_at, total_value, now) -> datetime.timedelta:
+    """
+    How often a wallet should be polled.
+    The interval grows with the time since its balance last changed (POLL_IDLE_FACTOR of the idle time),
+    shrinks for wallets worth more than POLL_HIGH_VALUE_USD, and is clamped to the min/max bounds.
+    Wallets with no change in the activity window are polled at the max interval.
+    """
+    if last_change_at is None:
+        minutes = POLL_MAX_INTERVAL_MINUTES
+    else:
+        minutes = (now - last_change_at).total_seconds() / 60 * POLL_IDLE_FACTOR
+
+    if total_value and total_value > POLL_HIGH_VALUE_USD:
+        minutes /= math.sqrt(total_value / POLL_HIGH_VALUE_USD)
+
+    return datetime.timedelta(minutes=min(max(minutes, POLL_MIN_INTERVAL_MINUTES), POLL_MAX_INTERVAL_MINUTES))
+
+def is_due(activity, now) -> bool:
+    """
+    Whether a wallet is due for a check, wallets never checked are always due
+    """
+    if activity is None or activity['checked_at'] is None:
+        return True
+    interval = poll_interval(activity['last_change_at'], float(activity['total_value'] or 0), now)
+    return now - activity['checked_at'] >= interval
+
+async def select_due_wallets(wallets):
+    """
+    Filter wallets down to the ones due for a check, based on the activity in wallet_balance_history
+    """
+    activities = await get_wallet_activity(POLL_ACTIVITY_WINDOW_DAYS)
+    activity_by_address = {activity['wallet_address']: activity for activity in activities}
+    # Timestamps are stored in db time, so compare against the db's clock
+    now = activities[0]['now'] if activities else datetime.datetime.utcnow()
+    return [wallet for wallet in wallets if is_due(activity_by_address.get(wallet['wallet_address']), now)]
@@ -0,0 +1,78 @@
+import cProfile
+import datetime
+import io
+import os
+import pstats
+import sys
+import tracemalloc
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+from utils import logger
+
+load_dotenv()
+
+PROFILE = os.getenv('PROFILE', 'false').lower() in ('1', 'true', 'yes')
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_TOP_N = int(os.getenv('PROFILE_TOP_N', 25))
+PROFILE_TRACEMALLOC_FRAMES = 10
+
+
+def profiling_enabled() -> bool:
+    """
+    Profile when PROFILE is set or the script was started with --profile
+    """
+    return PROFILE or '--profile' in sys.argv[1:]
+
+def write_report(path, run, profiler, snapshot, peak_bytes, top_n=PROFILE_TOP_N):
+    """
+    Write the top_n functions by cumulative and own time, and the top_n allocation sites still held at the end
+    """
+    with open(path, 'w') as report:
+        report.write(f'{run} profile, {datetime.datetime.now():%Y-%m-%d %H:%M:%S}\n')
+        report.write('CPU times are inflated by tracemalloc, compare them between runs rather than reading them as absolute.\n')
+        report.write('Only the event loop thread is profiled, db queries run in worker threads and show up as waits.\n\n')
+
+        for sort_key in ('cumulative', 'tottime'):
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).strip_dirs().sort_stats(sort_key).print_stats(top_n)
+            report.write(f'Top {top_n} functions by {sort_key} time\n')
+            report.write(stream.getvalue().strip() + '\n\n')
+
+        report.write(f'Peak traced memory: {peak_bytes / 2**20:.1f} MiB\n\n')
+        report.write(f'Top {top_n} allocation sites held at the end of the run\n')
+        for stat in snapshot.statistics('lineno')[:top_n]:
+            report.write(f'{stat}\n')
+
+@contextmanager
+def profiled(run: str, enabled: bool = None):
+    """
+    Profile the block with cProfile and tracemalloc when enabled (defaults to profiling_enabled()).
+    Writes <PROFILE_DIR>/<run>-<timestamp>.prof (open with pstats or snakeviz), .tracemalloc
+    (tracemalloc.Snapshot.load) and a .txt report of the top PROFILE_TOP_N hot spots and allocations.
+    """
+    if enabled is None:
+        enabled = profiling_enabled()
+    if not enabled:
+        yield
+        return
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    base_path = os.path.join(PROFILE_DIR, f'{run}-{datetime.datetime.now():%Y%m%d-%H%M%S}')
+
+    tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        profiler.dump_stats(f'{base_path}.prof')
+        snapshot.dump(f'{base_path}.tracemalloc')
+        write_report(f'{base_path}.txt', run, profiler, snapshot, peak_bytes)
+        logger.info(f'Profile written to {base_path}.txt (.prof, .tracemalloc)')
@@ -0,0 +1,155 @@
+import asyncio
+import time
+from email.utils import parsedate_to_datetime
+
+# Longest a waiter sleeps before checking key health again
+ACQUIRE_RECHECK_SECONDS = 1.0
+
+
+class AllKeysRejectedError(RuntimeError):
+    """
+    Every API key was rejected (401/403) and is still sitting out its cooldown
+    """
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at `rate` tokens per second, holding at most `capacity`
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def take(self):
+        self.tokens -= 1
+
+    def drain(self):
+        self.tokens = 0
+
+    def seconds_until_available(self) -> float:
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class ApiKey:
+    """
+    An API key with its own token bucket and health state, name is safe to log
+    """
+    def __init__(self, key: str, rate: float, capacity: float, name: str = None):
+        self.key = key
+        self.name = name or f'...{key[-4:]}'
+        self.bucket = TokenBucket(rate, capacity)
+        self.cooldown_until = 0.0
+        self.strikes = 0
+        self.unauthorized = False # Last answered 401/403, until it succeeds again
+
+    def is_cooling_down(self, now: float) -> bool:
+        return now < self.cooldown_until
+
+    def seconds_until_ready(self, now: float) -> float:
+        return max(self.cooldown_until - now, self.bucket.seconds_until_available())
+
+
+class KeyScheduler:
+    """
+    Schedules requests across several API keys.
+    Each request goes to the healthy key with the most tokens left; keys that hit a 429
+    or keep failing are put on a cooldown (Retry-After if given, else exponential backoff).
+    Keys that are rejected (revoked, out of quota) sit out unauthorized_cooldown before being tried again.
+    """
+    def __init__(self, keys: list[str], rate: float, capacity: float, base_backoff: float = 1.0, max_backoff: float = 60.0,
+                 unauthorized_cooldown: float = 3600.0):
+        if not keys:
+            raise ValueError('At least one API key is required')
+        self.keys = [ApiKey(key, rate, capacity, f'key{index}') for index, key in enumerate(keys, 1)]
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.unauthorized_cooldown = unauthorized_cooldown
+        self._lock = None
+
+    async def acquire(self) -> ApiKey:
+        """
+        Wait until a key has capacity, take a token from it and return it.
+        Raises AllKeysRejectedError instead of waiting out the cooldown when every key was rejected.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        # Serialise waiters so the earliest caller gets the next free token
+        async with self._lock:
+            while True:
+                if self.all_unauthorized():
+                    raise AllKeysRejectedError('All Solana Tracker API keys were rejected (401/403), they are retried after their cooldown')
+
+                now = time.monotonic()
+                for api_key in self.keys:
+                    api_key.bucket.refill(now)
+
+                ready = [api_key for api_key in self.keys if not api_key.is_cooling_down(now)]
+                if ready:
+                    best = max(ready, key=lambda api_key: api_key.bucket.tokens)
+                    if best.bucket.tokens >= 1:
+                        best.bucket.take()
+                        return best
+
+                await asyncio.sleep(min(ACQUIRE_RECHECK_SECONDS, *(api_key.seconds_until_ready(now) for api_key in self.keys)))
+
+    def report_success(self, api_key: ApiKey):
+        api_key.strikes = 0
+        api_key.unauthorized = False
+
+    def report_rate_limited(self, api_key: ApiKey, retry_after: float | None = None):
+        """
+        Back off a key that returned 429, honouring Retry-After when present
+        """
+        api_key.strikes += 1
+        api_key.bucket.drain()
+        self._cool_down(api_key, retry_after)
+
+    def report_failure(self, api_key: ApiKey):
+        """
+        Back off a key after a server or connection error
+        """
+        api_key.strikes += 1
+        self._cool_down(api_key)
+
+    def report_unauthorized(self, api_key: ApiKey):
+        """
+        Take a key that returned 401/403 out of rotation for unauthorized_cooldown
+        """
+        api_key.strikes += 1
+        api_key.unauthorized = True
+        self._cool_down(api_key, self.unauthorized_cooldown)
+
+    def all_unauthorized(self) -> bool:
+        """
+        Whether every key was rejected and is still sitting out its cooldown
+        """
+        now = time.monotonic()
+        return all(api_key.unauthorized and api_key.is_cooling_down(now) for api_key in self.keys)
+
+    def _cool_down(self, api_key: ApiKey, delay: float | None = None):
+        if delay is None:
+            delay = min(self.max_backoff, self.base_backoff * 2 ** (api_key.strikes - 1))
+        api_key.cooldown_until = max(api_key.cooldown_until, time.monotonic() + delay)
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """
+    Parse a Retry-After header (seconds or HTTP date) into a delay in seconds
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
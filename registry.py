@@ -0,0 +1,45 @@
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Mapping
+
+
+@dataclass(frozen=True)
+class Registry:
+    """
+    Immutable snapshot of the tracked wallets and tokens, indexed by address.
+    A refresh builds a new Registry and swaps it in, so readers never see a half loaded one.
+    """
+    wallets: tuple
+    tokens: tuple
+    wallets_by_address: Mapping[str, Mapping]
+    tokens_by_address: Mapping[str, Mapping]
+    trade_wallets: tuple
+    balance_wallets: tuple
+
+    @classmethod
+    def build(cls, wallets, tokens, trade_wallet_aliases) -> 'Registry':
+        """
+        Index wallets and tokens by address and split wallets into trade wallets
+        (alias contains one of trade_wallet_aliases) and balance wallets
+        """
+        wallets = tuple(MappingProxyType(dict(wallet)) for wallet in wallets)
+        tokens = tuple(MappingProxyType(dict(token)) for token in tokens)
+
+        trade_wallets = tuple(
+            wallet for wallet in wallets
+            if any(alias in (wallet['alias'] or '') for alias in trade_wallet_aliases)
+        )
+        trade_wallet_addresses = {wallet['wallet_address'] for wallet in trade_wallets}
+
+        return cls(
+            wallets=wallets,
+            tokens=tokens,
+            wallets_by_address=MappingProxyType({wallet['wallet_address']: wallet for wallet in wallets}),
+            tokens_by_address=MappingProxyType({token['token_address']: token for token in tokens}),
+            trade_wallets=trade_wallets,
+            balance_wallets=tuple(wallet for wallet in wallets if wallet['wallet_address'] not in trade_wallet_addresses),
+        )
+
+    @property
+    def token_addresses(self) -> list[str]:
+        return list(self.tokens_by_address)
@@ -0,0 +1,150 @@
+import asyncio
+import os
+import time
+
+import aiohttp
+from dotenv import load_dotenv
+
+from db import init_db_pool, close_db_pool
+from metrics import start_metrics_server
+from outbox import OUTBOX_POLL_SECONDS, create_webhooks, deliver_all_pending
+from solana_tracker import close_session
+from utils import logger
+from wallet_tracker import refresh_registry, watch_registry
+
+load_dotenv()
+
+BALANCE_CHECK_INTERVAL_MINUTES = float(os.getenv('BALANCE_CHECK_INTERVAL_MINUTES', 60))
+TRADE_CHECK_INTERVAL_MINUTES = float(os.getenv('TRADE_CHECK_INTERVAL_MINUTES', 5))
+
+_webhook_session = None
+_tasks = []
+
+
+class PeriodicJob:
+    """
+    Runs a coroutine function every interval_seconds, measured from the start of each run.
+    Runs of the same job never overlap, a run that is still going when the next one is due delays it.
+    log_success: log every finished run, off for jobs that run every few seconds
+    """
+    def __init__(self, name, func, interval_seconds, log_success=True):
+        self.name = name
+        self.func = func
+        self.interval_seconds = interval_seconds
+        self.log_success = log_success
+        self._lock = asyncio.Lock()
+
+    async def run_once(self):
+        """
+        Run the job now, skipping if a run is already in progress
+        """
+        if self._lock.locked():
+            logger.warning(f'{self.name}: previous run still in progress, skipping')
+            return
+
+        async with self._lock:
+            start = time.perf_counter()
+            try:
+                await self.func()
+            except Exception as e:
+                logger.exception(f'{self.name}: run failed after {time.perf_counter() - start:.1f}s: {e}')
+            else:
+                if self.log_success:
+                    logger.info(f'{self.name}: run finished in {time.perf_counter() - start:.1f}s')
+
+    async def run_forever(self):
+        while True:
+            start = time.monotonic()
+            await self.run_once()
+            await asyncio.sleep(max(0, self.interval_seconds - (time.monotonic() - start)))
+
+
+def create_jobs(session: aiohttp.ClientSession) -> list[PeriodicJob]:
+    """
+    Create a job for each check with an interval and webhook configured, plus one delivering
+    the notifications the checks queue in the outbox.
+    The check modules read their webhook urls on import, so they're only imported when enabled.
+    """
+    jobs = []
+
+    if BALANCE_CHECK_INTERVAL_MINUTES > 0 and os.getenv('DISCORD_WEBHOOK_WALLET_TRACKER_URL'):
+        from check_wallet_balances import check_and_enqueue_wallet_balances
+
+        async def run_check_wallet_balances():
+            await refresh_registry()
+            await check_and_enqueue_wallet_balances()
+
+        jobs.append(PeriodicJob('check_wallet_balances', run_check_wallet_balances, BALANCE_CHECK_INTERVAL_MINUTES * 60))
+
+    if TRADE_CHECK_INTERVAL_MINUTES > 0 and os.getenv('DISCORD_WEBHOOK_TRADES_URL'):
+        from check_trades import check_and_enqueue_trades
+
+        async def run_check_trades():
+            await refresh_registry()
+            await check_and_enqueue_trades()
+
+        jobs.append(PeriodicJob('check_trades', run_check_trades, TRADE_CHECK_INTERVAL_MINUTES * 60))
+
+    webhooks = create_webhooks(session)
+    if jobs and webhooks:
+        # Delivery runs on its own schedule so a slow or failing webhook never holds up a check
+        async def run_deliver_notifications():
+            await refresh_registry()
+            delivered = await deliver_all_pending(webhooks)
+            if delivered:
+                logger.info(f'Delivered {delivered} notifications')
+
+        jobs.append(PeriodicJob('deliver_notifications', run_deliver_notifications, OUTBOX_POLL_SECONDS, log_success=False))
+
+    return jobs
+
+async def start_scheduler() -> list[asyncio.Task]:
+    """
+    Start the periodic jobs on the running event loop, does nothing if already started
+    """
+    global _webhook_session, _tasks
+    if _tasks:
+        return _tasks
+
+    await init_db_pool()
+    _webhook_session = aiohttp.ClientSession()
+    jobs = create_jobs(_webhook_session)
+    for job in jobs:
+        logger.info(f'Scheduling {job.name} every {job.interval_seconds / 60:g} minutes')
+    _tasks = [asyncio.create_task(job.run_forever(), name=job.name) for job in jobs]
+    return _tasks
+
+async def stop_scheduler():
+    """
+    Cancel the periodic jobs and close the webhook session
+    """
+    global _webhook_session, _tasks
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks = []
+    if _webhook_session is not None:
+        await _webhook_session.close()
+        _webhook_session = None
+
+async def main():
+    await init_db_pool()
+    await start_metrics_server()
+    try:
+        await watch_registry()
+    except Exception as e:
+        logger.warning(f'Error listening for registry changes, falling back to version checks: {e}')
+
+    try:
+        tasks = await start_scheduler()
+        if not tasks:
+            logger.warning('No jobs configured, set the check intervals and webhook urls')
+            return
+        await asyncio.gather(*tasks)
+    finally:
+        await stop_scheduler()
+        await close_session()
+        await close_db_pool()
+
+if __name__ == '__main__':
+    asyncio.run(main())
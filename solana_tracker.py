@@ -1,50 +1,187 @@
+import asyncio
+import datetime
 import os
-import requests
+import time
 
+import aiohttp
 from dotenv import load_dotenv
+import ijson
+import numpy as np
 import pandas as pd
 
+import metrics
+from balances import DEFAULT_DECIMALS, to_micro_usd, to_raw_amounts
+from rate_limiter import KeyScheduler, parse_retry_after
+
 
 load_dotenv()
 
-API_KEY_1 = os.getenv('SOLANA_TRACKER_API_KEY_1')
-API_KEY_2 = os.getenv('SOLANA_TRACKER_API_KEY_2')
-BASE_URL = 'https://data.solanatracker.io'
-api_key_list = [API_KEY_1, API_KEY_2]
-_current_api_key_index = 0
+BASE_URL = os.getenv('SOLANA_TRACKER_BASE_URL', 'https://data.solanatracker.io')
+REQUEST_TIMEOUT_SECONDS = float(os.getenv('SOLANA_TRACKER_TIMEOUT_SECONDS', 30))
+REQUESTS_PER_SECOND = float(os.getenv('SOLANA_TRACKER_REQUESTS_PER_SECOND', 1))
+BURST = float(os.getenv('SOLANA_TRACKER_BURST', 1))
+MAX_RETRIES = int(os.getenv('SOLANA_TRACKER_MAX_RETRIES', 5))
+UNAUTHORIZED_COOLDOWN_SECONDS = float(os.getenv('SOLANA_TRACKER_UNAUTHORIZED_COOLDOWN_SECONDS', 3600))
+TRADES_BACKFILL_PAGES = int(os.getenv('TRADES_BACKFILL_PAGES', 1))
+TRADES_MAX_PAGES = int(os.getenv('TRADES_MAX_PAGES', 10))
+TRADE_COLUMNS = ['tx_hash', 'from_token', 'to_token', 'price', 'volume', 'timestamp']
+WALLET_BALANCE_COLUMNS = ['token_address', 'balance_raw', 'decimals', 'value_micro']
 
-def get_api_key():
+def _load_api_keys():
     """
-    Alternates between the two API keys with each call
+    Read SOLANA_TRACKER_API_KEY_1, SOLANA_TRACKER_API_KEY_2, ... until one is missing
     """
-    global _current_api_key_index
-    api_key = api_key_list[_current_api_key_index]
-    _current_api_key_index = (_current_api_key_index + 1) % len(api_key_list)
-    return api_key
+    keys = []
+    while key := os.getenv(f'SOLANA_TRACKER_API_KEY_{len(keys) + 1}'):
+        keys.append(key)
+    if not keys and os.getenv('SOLANA_TRACKER_API_KEY'):
+        keys.append(os.getenv('SOLANA_TRACKER_API_KEY'))
+    return keys
+
+api_key_list = _load_api_keys()
+_scheduler = None
+_session = None
 
-async def get_wallet_balance(wallet_address):
+def get_scheduler() -> KeyScheduler:
     """
-    Get the balance of a wallet, return dataframe of all tokens and their balances
+    Get the shared API key scheduler, creating it on first use
     """
-    url = f'{BASE_URL}/wallet/{wallet_address}'
-    headers = {'x-api-key': get_api_key()}
-    response = requests.get(url, headers=headers).json()
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = KeyScheduler(
+            api_key_list, REQUESTS_PER_SECOND, BURST, unauthorized_cooldown=UNAUTHORIZED_COOLDOWN_SECONDS
+        )
+    return _scheduler
 
-    tokens = response['tokens']
-    df = pd.DataFrame(tokens).drop(columns=['pools', 'events', 'risk', 'buys', 'sells', 'txns'])
-    df['token_address'] = df['token'].apply(lambda x: x.get('mint')) # Error where some tokens don't have a mint, skip over them
-    df.drop(columns=['token'], inplace=True)
-    df.dropna(inplace=True)
+def get_session() -> aiohttp.ClientSession:
+    """
+    Get the shared aiohttp session, creating it on first use
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SECONDS)
+        )
+    return _session
 
-    return df
+async def close_session():
+    """
+    Close the shared aiohttp session
+    """
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+async def get_json(path, params=None, endpoint=None, parse=None):
+    """
+    Send a GET request to the Solana Tracker API and return the decoded JSON body.
+    Requests are spread over the API keys by the scheduler, 429s, server errors and rejected keys (401/403)
+    are retried on the next free key.
+    endpoint: path template used to label metrics, defaults to path
+    parse: optional coroutine function decoding the body from the response instead of response.json()
+    """
+    session = get_session()
+    scheduler = get_scheduler()
+    endpoint = endpoint or path
+
+    for attempt in range(MAX_RETRIES + 1):
+        api_key = await scheduler.acquire()
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            async with session.get(f'{BASE_URL}{path}', params=params, headers={'x-api-key': api_key.key}) as response:
+                status = response.status
+                if response.status == 429:
+                    metrics.inc('api_rate_limited', key=api_key.name, endpoint=endpoint)
+                    scheduler.report_rate_limited(api_key, parse_retry_after(response.headers.get('Retry-After')))
+                    error = aiohttp.ClientResponseError(
+                        response.request_info, response.history, status=response.status, message=response.reason
+                    )
+                    continue
+                if response.status in (401, 403):
+                    metrics.inc('api_unauthorized', key=api_key.name, endpoint=endpoint)
+                    scheduler.report_unauthorized(api_key)
+                    error = aiohttp.ClientResponseError(
+                        response.request_info, response.history, status=response.status, message=response.reason
+                    )
+                    continue
+                if response.status >= 500:
+                    scheduler.report_failure(api_key)
+                    error = aiohttp.ClientResponseError(
+                        response.request_info, response.history, status=response.status, message=response.reason
+                    )
+                    continue
+                response.raise_for_status()
+                data = await parse(response) if parse else await response.json()
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            scheduler.report_failure(api_key)
+            error = e
+            continue
+        finally:
+            metrics.observe('api_request', time.perf_counter() - start, key=api_key.name, endpoint=endpoint, status=status)
+
+        scheduler.report_success(api_key)
+        return data
+
+    raise error
+
+async def parse_wallet_tokens(stream, token_addresses=None):
+    """
+    Pull mint, decimals, balance and value out of a /wallet response as it streams in, one token at a time,
+    so the whole body and its pools/events/risk blobs are never held at once.
+    Tokens without a mint, balance or value are skipped, as are repeats of a mint (the first is kept),
+    with token_addresses only those tokens are kept.
+    Returns (tokens in the response, {token_address: [...], decimals: [...], balance: [...], value: [...]})
+    """
+    token_count = 0
+    columns = {'token_address': [], 'decimals': [], 'balance': [], 'value': []}
+    seen = set()
+    async for holding in ijson.items_async(stream, 'tokens.item', use_float=True):
+        token_count += 1
+        token = holding.get('token') or {}
+        mint, decimals = token.get('mint'), token.get('decimals') # Error where some tokens don't have a mint, skip over them
+        balance, value = holding.get('balance'), holding.get('value')
+        if mint is None or balance is None or value is None:
+            continue
+        if (token_addresses is not None and mint not in token_addresses) or mint in seen:
+            continue
+        seen.add(mint)
+        columns['token_address'].append(mint)
+        columns['decimals'].append(DEFAULT_DECIMALS if decimals is None else decimals)
+        columns['balance'].append(balance)
+        columns['value'].append(value)
+    return token_count, columns
+
+async def get_wallet_balance(wallet_address, token_addresses=None):
+    """
+    Get the balance of a wallet, return dataframe of its tokens with their raw balances
+    (token_address, balance_raw, decimals, value_micro, see balances.py).
+    token_addresses: optional set of tokens to keep, the rest are dropped while parsing
+    """
+    token_count, columns = await get_json(
+        f'/wallet/{wallet_address}',
+        endpoint='/wallet/{address}',
+        parse=lambda response: parse_wallet_tokens(response.content, token_addresses)
+    )
+
+    metrics.inc('api_rows_fetched', token_count, endpoint='/wallet/{address}')
+    if not columns['token_address']:
+        return pd.DataFrame(columns=WALLET_BALANCE_COLUMNS)
+
+    decimals = np.array(columns['decimals'], dtype='int64')
+    return pd.DataFrame({
+        'token_address': np.array(columns['token_address'], dtype=object),
+        'balance_raw': to_raw_amounts(columns['balance'], decimals),
+        'decimals': decimals,
+        'value_micro': to_micro_usd(columns['value']),
+    })
 
 async def get_token_info(token_address):
     """
     Get the info of a token
     """
-    url = f'{BASE_URL}/tokens/{token_address}'
-    headers = {'x-api-key': get_api_key()}
-    response = requests.get(url, headers=headers).json()
+    response = await get_json(f'/tokens/{token_address}', endpoint='/tokens/{address}')
 
     token = response['token']
 
@@ -54,15 +191,49 @@ async def get_token_info(token_address):
         token['symbol'],
     )
 
-async def get_wallet_trades(wallet_address):
+async def get_token_infos(token_addresses):
     """
-    Get the trades of a wallet
+    Get the info of several tokens, the lookups run concurrently and are rate limited by get_json.
+    Returns a tuple of (infos by address, errors by address)
     """
-    url = f'{BASE_URL}/wallet/{wallet_address}/trades'
-    headers = {'x-api-key': get_api_key()}
-    response = requests.get(url, headers=headers).json()
+    results = await asyncio.gather(*[get_token_info(token_address) for token_address in token_addresses], return_exceptions=True)
+    infos, errors = {}, {}
+    for token_address, result in zip(token_addresses, results):
+        if isinstance(result, Exception):
+            errors[token_address] = result
+        else:
+            infos[token_address] = result
+    return infos, errors
+
+async def get_wallet_trades(wallet_address, since_tx_hash=None, since_time=None):
+    """
+    Get the trades of a wallet, newest first.
+    When since_tx_hash/since_time (the newest trade already seen) are given, pages are fetched
+    only until that trade is reached. Without them only TRADES_BACKFILL_PAGES pages are fetched.
+    """
+    since_ms = int(since_time.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000) if since_time else None
+    max_pages = TRADES_MAX_PAGES if since_tx_hash or since_ms else TRADES_BACKFILL_PAGES
+
+    trades = []
+    params = None
+    for _ in range(max_pages):
+        response = await get_json(f'/wallet/{wallet_address}/trades', params=params, endpoint='/wallet/{address}/trades')
+
+        metrics.inc('api_rows_fetched', len(response['trades']), endpoint='/wallet/{address}/trades')
+        reached_known_trade = False
+        for trade in response['trades']:
+            if trade['tx'] == since_tx_hash or (since_ms is not None and trade['time'] < since_ms):
+                reached_known_trade = True
+                break
+            trades.append(trade)
+
+        if reached_known_trade or not response.get('hasNextPage') or not response.get('nextCursor'):
+            break
+        params = {'cursor': response['nextCursor']}
+
+    if not trades:
+        return pd.DataFrame(columns=TRADE_COLUMNS)
 
-    trades = response['trades']
     df = pd.DataFrame(trades).drop(columns=['wallet'])
     df = df.assign(
         from_token=df['from'].apply(lambda x: x.get('token', {}).get('symbol')),
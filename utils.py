@@ -1,9 +1,13 @@
+import asyncio
 import datetime
 import logging
+import os
 import sys
+import time
 
 import discord
 
+import metrics
 from wallet_tracker import format_balance_change, create_token_summary, format_trades
 
 
@@ -20,42 +24,200 @@ if not logger.handlers:
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
+STATUS_UPDATE_INTERVAL_SECONDS = float(os.getenv('STATUS_UPDATE_INTERVAL_SECONDS', 2))
+
+class StatusReporter:
+    """
+    Coalesces status updates into at most one edit per interval_seconds.
+    update() only records the latest message, the edits happen in a background task so callers never wait on Discord.
+    edit: async function taking a content keyword argument, e.g. message.edit
+    """
+    def __init__(self, edit, interval_seconds=STATUS_UPDATE_INTERVAL_SECONDS):
+        self.edit = edit
+        self.interval_seconds = interval_seconds
+        self.latest = None
+        self._changed = asyncio.Event()
+        self._task = None
+
+    async def update(self, message: str):
+        self.latest = message
+        self._changed.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self, final_message: str = None):
+        """
+        Stop the background edits, optionally replacing the status with a final message
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if final_message is not None:
+            await self.edit(content=final_message)
+
+    async def _run(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            try:
+                with metrics.timer('discord_send', kind='status'):
+                    await self.edit(content=self.latest)
+            except Exception as e:
+                logger.warning(f'Failed to update status: {e}')
+            await asyncio.sleep(self.interval_seconds)
+
+# Discord message limits, see https://discord.com/developers/docs/resources/message#embed-object-embed-limits
+EMBED_MAX_FIELDS = 25
+MESSAGE_MAX_EMBEDS = 10
+MESSAGE_MAX_EMBED_CHARS = 6000
+MESSAGE_MAX_CONTENT_CHARS = 2000
+EMBED_MAX_DESCRIPTION_CHARS = 4096
+
+def create_balance_change_field(change):
+    """
+    Returns a tuple of (name, value) for a balance change embed field
+    """
+    name, fields = format_balance_change(change)
+    return name, '\n'.join(
+        f"{field['name']}: {field['value']}"
+        for field in fields
+    )
+
 def create_wallet_balance_change_embed(changes_batch, previous_check_time=None, page=1, total_pages=1):
+    """
+    total_pages can be None when changes are sent as they arrive and the page count isn't known yet
+    """
+    if total_pages is None:
+        page_text = f" (Page {page})"
+    else:
+        page_text = f" (Page {page}/{total_pages})" if total_pages > 1 else ""
+
     embed = discord.Embed(
         title='💰 Wallet Balance Changes',
-        description=f'Recent significant changes in wallet balances{f" (Page {page}/{total_pages})" if total_pages > 1 else ""}\n(as of {previous_check_time if previous_check_time else ""})',
+        description=f'Recent significant changes in wallet balances{page_text}\n(as of {previous_check_time if previous_check_time else ""})',
         color=discord.Color.brand_green(),
         timestamp=datetime.datetime.now()
     )
     
     for change in changes_batch:
-        name, fields = format_balance_change(change)
-        
-        embed.add_field(
-            name=name,
-            value='\n'.join(
-                f"{field['name']}: {field['value']}"
-                for field in fields
-            ),
-            inline=False
-        )
+        name, value = create_balance_change_field(change)
+        embed.add_field(name=name, value=value, inline=False)
     
     embed.set_footer(text='Last updated')
     return embed
 
-def create_token_flow_summary_embed(changes):
-    embed = discord.Embed(
-        title='📊 Token Flow Summary',
-        description='Aggregate canges by token',
-        color=discord.Color.dark_teal(),
-        timestamp=datetime.datetime.now()
-    )
-    
-    summary = create_token_summary(changes)
-    embed.description = summary
-    
-    embed.set_footer(text='Last updated')
-    return embed
+class BalanceChangePublisher:
+    """
+    Sends balance changes as they arrive, packed into as few messages as Discord allows.
+    Each page (embed) holds up to EMBED_MAX_FIELDS changes, and each message up to MESSAGE_MAX_EMBEDS pages
+    within MESSAGE_MAX_EMBED_CHARS. A message is sent once the next change doesn't fit, or once its oldest
+    change has waited max_delay_seconds. The token flow summary is sent on close, starting in the last message if it fits.
+    send: async function taking an embeds keyword argument, e.g. webhook.send
+    first_page: page number to continue from, when earlier pages of the same run were already sent
+    """
+    def __init__(self, send, previous_check_time=None, max_delay_seconds=30, first_page=1):
+        self.send = send
+        self.previous_check_time = previous_check_time
+        self.max_delay_seconds = max_delay_seconds
+        self.changes = []
+        self.embeds = [] # Pages of the message being built
+        self.pending_since = None
+        self.page = first_page - 1
+
+    async def add(self, changes):
+        for change in changes:
+            with metrics.timer('discord_render', kind='balance_changes'):
+                name, value = create_balance_change_field(change)
+            field_length = len(name) + len(value)
+            if (
+                not self.embeds
+                or len(self.embeds[-1].fields) >= EMBED_MAX_FIELDS
+                or self._message_length() + field_length > MESSAGE_MAX_EMBED_CHARS
+            ):
+                await self._start_page(field_length)
+            self.embeds[-1].add_field(name=name, value=value, inline=False)
+            self.changes.append(change)
+
+        if self.embeds and time.monotonic() - self.pending_since >= self.max_delay_seconds:
+            await self._flush()
+
+    async def add_summary(self, changes):
+        """
+        Add the token flow summary of changes, packed after the pages added so far
+        """
+        with metrics.timer('discord_render', kind='token_flow_summary'):
+            summaries = create_token_flow_summary_embeds(changes)
+        for summary in summaries:
+            if not self._fits(len(summary)):
+                await self._flush()
+            if not self.embeds:
+                self.pending_since = time.monotonic()
+            self.embeds.append(summary)
+
+    async def close(self, summary=True) -> int:
+        """
+        Send any remaining changes and, unless summary is False, the summary of the added changes.
+        Returns the number of changes sent
+        """
+        if summary and self.changes:
+            await self.add_summary(self.changes)
+        await self._flush()
+        return len(self.changes)
+
+    def _message_length(self) -> int:
+        return sum(len(embed) for embed in self.embeds)
+
+    def _fits(self, length) -> bool:
+        return len(self.embeds) < MESSAGE_MAX_EMBEDS and self._message_length() + length <= MESSAGE_MAX_EMBED_CHARS
+
+    async def _start_page(self, field_length):
+        """
+        Start a new page, sending the current message first if the page and its first field don't fit in it
+        """
+        self.page += 1
+        embed = create_wallet_balance_change_embed(
+            [],
+            self.previous_check_time if self.page == 1 else None,
+            self.page,
+            None
+        )
+        if not self._fits(len(embed) + field_length):
+            await self._flush()
+        if not self.embeds:
+            self.pending_since = time.monotonic()
+        self.embeds.append(embed)
+
+    async def _flush(self):
+        if self.embeds:
+            with metrics.timer('discord_send', kind='balance_changes'):
+                await self.send(embeds=self.embeds)
+        self.embeds = []
+        self.pending_since = None
+
+def create_token_flow_summary_embeds(changes):
+    """
+    The token flow summary as embeds, split between tokens so each description stays within EMBED_MAX_DESCRIPTION_CHARS
+    """
+    descriptions = []
+    for block in create_token_summary(changes):
+        if descriptions and len(descriptions[-1]) + 1 + len(block) <= EMBED_MAX_DESCRIPTION_CHARS:
+            descriptions[-1] += '\n' + block
+        else:
+            descriptions.append(block[:EMBED_MAX_DESCRIPTION_CHARS])
+
+    embeds = []
+    for page, description in enumerate(descriptions, start=1):
+        page_text = f' (Page {page}/{len(descriptions)})' if len(descriptions) > 1 else ''
+        embed = discord.Embed(
+            title=f'📊 Token Flow Summary{page_text}',
+            description=description,
+            color=discord.Color.dark_teal(),
+            timestamp=datetime.datetime.now()
+        )
+        embed.set_footer(text='Last updated')
+        embeds.append(embed)
+    return embeds
 
 def create_wallet_trade_embed(trades):
     embed = discord.Embed(
@@ -1,16 +1,30 @@
+import asyncio
+import os
+import time
+from contextlib import aclosing
 from datetime import datetime
-from decimal import Decimal
+from typing import AsyncIterator, Mapping, NamedTuple
 import pytz
 
 import pandas as pd
 
-from db import get_previous_wallet_balance, get_all_wallets, get_all_tokens, upsert_wallets, upsert_tokens, upsert_wallet_balances, upsert_wallet_trades, get_previous_wallet_trades
-from solana_tracker import get_wallet_balance, get_token_info, get_wallet_trades
+import metrics
+from balances import BALANCE_COLUMNS, diff_balances, significant, to_int_array
+from db import get_previous_wallet_balance, get_previous_check_time, get_all_wallets, get_all_tokens, get_registry_version, listen_registry_changes, is_listening_for_registry_changes, upsert_wallets, upsert_tokens, upsert_wallet_balances, upsert_wallet_trades, get_wallet_trade_cursors, upsert_wallet_trade_cursors, start_balance_run, record_balance_run_failure, finish_balance_run
+from registry import Registry
+from solana_tracker import get_token_infos, get_wallet_balance, get_wallet_trades
 
 
 TRADE_WALLET_ALIASES = ['Phantom', 'BonkBot', 'Bloom']
-tokens = []
-wallets = []
+WALLET_FETCH_CONCURRENCY = int(os.getenv('WALLET_FETCH_CONCURRENCY', 8))
+WALLET_FETCH_RETRIES = int(os.getenv('WALLET_FETCH_RETRIES', 2))
+WALLET_RETRY_BACKOFF_SECONDS = float(os.getenv('WALLET_RETRY_BACKOFF_SECONDS', 5))
+BALANCE_RUN_RESUME_HOURS = float(os.getenv('BALANCE_RUN_RESUME_HOURS', 6))
+REGISTRY_MAX_AGE_SECONDS = float(os.getenv('REGISTRY_MAX_AGE_SECONDS', 300))
+registry = Registry.build([], [], TRADE_WALLET_ALIASES)
+registry_version = None
+registry_stale = True
+registry_verified_at = 0.0
 
 ########################
 # Helper Functions
@@ -48,7 +62,7 @@ def format_balance_change(change):
     return title, fields
 
 def create_token_summary(changes):
-    """Create a summary of token flows"""
+    """Create a summary of token flows, returns one block of text per token"""
     token_stats = {}
     
     for change in changes:
@@ -86,7 +100,7 @@ def create_token_summary(changes):
         )
         summary_lines.append(summary)
     
-    return '\n'.join(summary_lines)
+    return summary_lines
 
 def format_trades(trade):
     """
@@ -137,129 +151,270 @@ def format_datetime(utc_time: datetime) -> str:
 
 async def initialize():
     """
-    Initialize global variables
+    Load the wallet and token registry
     """
-    global tokens, wallets
-    tokens = await get_all_tokens()
-    wallets = await get_all_wallets()
+    global registry, registry_version, registry_stale, registry_verified_at
+    # Clear the flag first so a change notified while loading triggers another reload.
+    # The version is read before the tables, so a concurrent change is picked up by the next check.
+    registry_stale = False
+    version = await get_registry_version()
+    tokens, wallets = await asyncio.gather(get_all_tokens(), get_all_wallets())
+    registry = Registry.build(wallets, tokens, TRADE_WALLET_ALIASES)
+    registry_version = version
+    registry_verified_at = time.monotonic()
+
+def mark_registry_stale(payload=None):
+    """
+    Flag the registry for reload on the next refresh
+    """
+    global registry_stale
+    registry_stale = True
+
+async def watch_registry():
+    """
+    Listen for registry change notifications so refresh_registry can skip the version check
+    """
+    await listen_registry_changes(mark_registry_stale)
+
+async def refresh_registry():
+    """
+    Reload the registry only if it changed since it was loaded.
+    While listening for notifications the reload is driven by them, otherwise (or once the
+    snapshot is older than REGISTRY_MAX_AGE_SECONDS) the version counter is checked.
+    """
+    global registry_verified_at
+    if registry_stale:
+        await initialize()
+        return
+
+    listening = is_listening_for_registry_changes()
+    if listening and time.monotonic() - registry_verified_at < REGISTRY_MAX_AGE_SECONDS:
+        return
+
+    if await get_registry_version() != registry_version:
+        await initialize()
+    else:
+        registry_verified_at = time.monotonic()
 
 def get_token_name(token_address):
     """
     Get the name of a token
     """
-    token = [token for token in tokens if token['token_address'] == token_address][0]
-    return token['name']
+    return registry.tokens_by_address[token_address]['name']
 
 def get_token_symbol(token_address):
     """
     Get the symbol of a token
     """
-    token = [token for token in tokens if token['token_address'] == token_address][0]
-    return token['symbol']
+    return registry.tokens_by_address[token_address]['symbol']
 
 def get_wallet_alias(wallet_address):
     """
     Get the alias of a wallet
     """
-    wallet = [wallet for wallet in wallets if wallet['wallet_address'] == wallet_address][0]
-    return wallet['alias']
+    return registry.wallets_by_address[wallet_address]['alias']
 
 
-async def check_wallet_balances(status_callback=None) -> tuple[list[dict], str]:
-    """
-    Check the balance of all wallets, reports changes and upserts new balances to db
-    Returns a tuple of (changes, previous_check_time)
-    """
+class WalletBalanceResult(NamedTuple):
+    wallet: Mapping
+    changes: list[dict]
+    error: str | None = None # Set when the wallet still failed after its retries, changes is then empty
 
-    # Get current wallet balances
-    current_wallet_balances = pd.DataFrame()
-    token_addresses = [token['token_address'] for token in tokens]
-
-    for wallet in wallets:
-        # Skip trade wallets
-        if any(alias in wallet['alias'] for alias in TRADE_WALLET_ALIASES):
-            continue
-        
-        if status_callback:
-            await status_callback(f'Checking balance for wallet: {wallet["alias"]}...')
-            
-        try:
-            df = await get_wallet_balance(wallet['wallet_address'])
-        except Exception as e:
-            await status_callback(f'Error getting wallet balance for {wallet["alias"]}: {str(e)}')
-            raise e # Issue with dealing with API limits
-
-        # Add missing tokens with 0 balance, captures when a wallet sells out all of a token
-        missing_token_balances = pd.DataFrame({'token_address': token_addresses, 'balance': 0, 'value': 0})
-        df = pd.concat([df, missing_token_balances]).drop_duplicates(subset=['token_address'], keep='first')
-        
-        # Filter out any tokens that are not in the list of tokens
-        df = df[df['token_address'].isin(token_addresses)]
 
-        # Add wallet address to dataframe
-        df = df.assign(wallet_address=wallet['wallet_address'])
+# Balance runs load the previous balances up front and write them back per wallet, so two overlapping
+# runs would diff against stale balances and alert the same change twice
+balance_run_lock = asyncio.Lock()
 
-        # Append to current wallet balances
-        current_wallet_balances = pd.concat([current_wallet_balances, df])
-
-    # Get previous wallet balances
-    previous_wallet_balances = pd.DataFrame(await get_previous_wallet_balance())
+async def get_previous_check_time_text() -> str:
+    """
+    When balances were last checked, formatted for display
+    """
+    previous_check_time = await get_previous_check_time()
+    return format_datetime(previous_check_time) if previous_check_time else 'No previous data'
 
-    previous_wallet_balances = previous_wallet_balances[previous_wallet_balances['token_address'].isin(token_addresses)]
-    previous_wallet_balances = previous_wallet_balances[previous_wallet_balances['wallet_address'].isin(current_wallet_balances['wallet_address'].unique())]
+async def stream_wallet_balances(status_callback=None, wallet_filter=None, notification_channel=None, resumable=False) -> AsyncIterator[WalletBalanceResult]:
+    """
+    Check the balance of all wallets, yielding each wallet's significant changes as soon as
+    that wallet has been fetched, compared and its new balances upserted to db
+    wallet_filter: optional async function narrowing down the wallets to check, e.g. polling.select_due_wallets
+    notification_channel: if set, the changes are also queued in the notification outbox in the same
+    transaction as the balances, for outbox.deliver_pending to send
+    resumable: journal the run in balance_runs, marking each wallet done with its balance write.
+    A run that didn't finish (crashed or stopped early) is resumed by the next resumable run within
+    BALANCE_RUN_RESUME_HOURS, which only checks the wallets it had left.
+
+    Failed fetches are retried WALLET_FETCH_RETRIES times with backoff, a wallet that still fails is
+    yielded with its error instead of stopping the run.
+    Runs in this process never overlap, a run waits for balance_run_lock.
+    """
+    async with balance_run_lock, aclosing(_stream_wallet_balances(
+        status_callback, wallet_filter, notification_channel, resumable
+    )) as results:
+        async for result in results:
+            yield result
+
+async def _stream_wallet_balances(status_callback, wallet_filter, notification_channel, resumable):
+
+    # Work from one registry snapshot for the whole run, trade wallets are skipped
+    current_registry = registry
+    tracked_tokens = set(current_registry.token_addresses)
+    balance_wallets = current_registry.balance_wallets
+    if wallet_filter:
+        balance_wallets = await wallet_filter(balance_wallets)
+
+    run_id = None
+    previous_check_time = None
+    if resumable:
+        run_id, pending_addresses, previous_check_time = await start_balance_run(
+            [wallet['wallet_address'] for wallet in balance_wallets],
+            BALANCE_RUN_RESUME_HOURS
+        )
+        balance_wallets = [
+            current_registry.wallets_by_address[wallet_address]
+            for wallet_address in pending_addresses
+            if wallet_address in current_registry.wallets_by_address
+        ]
+
+    # Get previous wallet balances up front, grouped by wallet
+    previous_wallet_balances = pd.DataFrame(
+        await get_previous_wallet_balance([wallet['wallet_address'] for wallet in balance_wallets]),
+        columns=BALANCE_COLUMNS
+    )
+    previous_wallet_balances = previous_wallet_balances[previous_wallet_balances['token_address'].isin(tracked_tokens)]
+    # NUMERIC columns come back as Decimals, convert them once rather than per wallet
+    previous_wallet_balances = previous_wallet_balances.assign(
+        balance_raw=to_int_array(previous_wallet_balances['balance_raw']),
+        value_micro=to_int_array(previous_wallet_balances['value_micro']),
+    )
+    previous_by_wallet = dict(tuple(previous_wallet_balances.groupby('wallet_address')))
+    no_previous_balances = previous_wallet_balances.iloc[0:0]
+    if resumable:
+        # Taken when the run started, a resumed run's finished wallets have already moved the latest check on
+        previous_check_time = format_datetime(previous_check_time) if previous_check_time else 'No previous data'
+    elif notification_channel:
+        previous_check_time = await get_previous_check_time_text()
+
+    # Fetch balances concurrently, bounded so we don't flood the API
+    semaphore = asyncio.Semaphore(WALLET_FETCH_CONCURRENCY)
+    completed = 0
+    errors = 0
+
+    async def fetch_wallet_balance(wallet):
+        """
+        Returns a tuple of (wallet, balances, error), rate limits are already retried by the client
+        """
+        nonlocal errors
+        for attempt in range(WALLET_FETCH_RETRIES + 1):
+            if attempt:
+                # Back off outside the semaphore so other wallets keep going
+                await asyncio.sleep(WALLET_RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+            async with semaphore:
+                try:
+                    return wallet, await get_wallet_balance(wallet['wallet_address'], tracked_tokens), None
+                except Exception as e:
+                    error = e
+
+        errors += 1
+        if status_callback:
+            await status_callback(f'{completed}/{len(fetches)} wallets, {errors} errors - error getting wallet balance for {wallet["alias"]}: {str(error)}')
+        return wallet, None, error
+
+    fetches = [asyncio.create_task(fetch_wallet_balance(wallet)) for wallet in balance_wallets]
+    start = time.perf_counter()
+
+    try:
+        # Process wallets as they complete rather than in wallet order
+        for fetch in asyncio.as_completed(fetches):
+            wallet, df, error = await fetch
+            completed += 1
+
+            if error is not None:
+                if run_id is not None:
+                    await record_balance_run_failure(run_id, wallet['wallet_address'], str(error))
+                yield WalletBalanceResult(wallet, [], str(error))
+                continue
+
+            # Progress is reported on every wallet, the callback is expected to be cheap (see utils.StatusReporter)
+            if status_callback:
+                await status_callback(f'{completed}/{len(fetches)} wallets, {errors} errors - checked {wallet["alias"]}')
+
+            # Only tracked tokens were kept while parsing the response
+            current_wallet_balances = df.assign(wallet_address=wallet['wallet_address'])[BALANCE_COLUMNS]
+
+            # Compare current and previous balances, tokens missing on either side count as 0
+            with metrics.timer('balance_diff'):
+                balance_changes = diff_balances(
+                    current_wallet_balances,
+                    previous_by_wallet.get(wallet['wallet_address'], no_previous_balances)
+                )
+
+            # Ignore SOL
+            significant_changes = balance_changes[significant(balance_changes) & (balance_changes['token_address'] != 'So11111111111111111111111111111111111111112')]
+
+            significant_changes = significant_changes.to_dict(orient='records')
+            notifications = [
+                (notification_channel, {'change': change, 'previous_check_time': previous_check_time})
+                for change in significant_changes
+            ] if notification_channel else None
+
+            # Update wallet balances in db, this is the wallet's checkpoint in the run
+            # Convert DataFrame to list of tuples for database insertion, tolist() gives ints psycopg2 can adapt
+            current_wallet_balances = current_wallet_balances[current_wallet_balances['balance_raw'] > 0]
+            await upsert_wallet_balances(list(zip(
+                current_wallet_balances['wallet_address'],
+                current_wallet_balances['token_address'],
+                current_wallet_balances['balance_raw'].tolist(),
+                current_wallet_balances['decimals'].tolist(),
+                current_wallet_balances['value_micro'].tolist()
+            )), [wallet['wallet_address']], notifications, run_id)
+
+            metrics.inc('balance_changes', len(significant_changes))
+            yield WalletBalanceResult(wallet, significant_changes)
+
+        # Wallets that still failed are reported, not resumed, the next run checks them again
+        if run_id is not None:
+            await finish_balance_run(run_id, notification_channel)
+    finally:
+        # Don't leave requests running if the consumer stopped early
+        for fetch in fetches:
+            fetch.cancel()
+        metrics.observe('check_wallet_balances', time.perf_counter() - start)
+        metrics.inc('wallets_checked', completed)
+        metrics.inc('wallet_check_errors', errors)
+
+async def check_wallet_balances(status_callback=None, wallet_filter=None) -> tuple[list[dict], str]:
+    """
+    Check the balance of all wallets, reports changes and upserts new balances to db
+    wallet_filter: optional async function narrowing down the wallets to check, e.g. polling.select_due_wallets
+    Returns a tuple of (changes, previous_check_time)
+    """
+    previous_check_time = await get_previous_check_time_text()
 
-    # Compare current and previous balances
-    current_wallet_balances = current_wallet_balances.sort_values(['wallet_address', 'token_address']).reset_index(drop=True)
-    previous_wallet_balances = previous_wallet_balances.sort_values(['wallet_address', 'token_address']).reset_index(drop=True)
+    changes = []
+    async for result in stream_wallet_balances(status_callback=status_callback, wallet_filter=wallet_filter):
+        changes.extend(result.changes)
 
-    # Assert that the two wallets have the same length
-    assert len(current_wallet_balances) == len(previous_wallet_balances)
-    
-    # Calculate changes
-    balance_changes = pd.DataFrame({
-        'wallet_address': current_wallet_balances['wallet_address'],
-        'token_address': current_wallet_balances['token_address'],
-        'previous_balance': previous_wallet_balances['balance'],
-        'current_balance': current_wallet_balances['balance'],
-        'balance_change': current_wallet_balances['balance'].apply(Decimal) - previous_wallet_balances['balance'],
-        'value_change': current_wallet_balances['value'].apply(Decimal) - previous_wallet_balances['value'],
-    })
-
-    # Ignore SOL
-    significant_changes = balance_changes[(abs(balance_changes['balance_change']) > 0.5) & (balance_changes['token_address'] != 'So11111111111111111111111111111111111111112')]
-
-    # Update wallet balances in db
-    # Convert DataFrame to list of tuples for database insertion
-    current_wallet_balances = current_wallet_balances[current_wallet_balances['balance'] > 0]
-    current_wallet_balances = list(zip(
-        current_wallet_balances['wallet_address'],
-        current_wallet_balances['token_address'],
-        current_wallet_balances['balance'],
-        current_wallet_balances['value']
-    ))
-    await upsert_wallet_balances(current_wallet_balances)
-
-    previous_check_time = format_datetime(previous_wallet_balances['previous_check_time'][0]) if previous_wallet_balances['previous_check_time'][0] else 'No previous data'
-
-    return significant_changes.to_dict(orient='records'), previous_check_time
+    return changes, previous_check_time
 
 async def list_wallets():
     """
     Return list of wallet dictionaries
     """
-    return wallets
+    return registry.wallets
 
 async def list_tokens():
     """
     Return list of token dictionaries
     """
-    return tokens
+    return registry.tokens
 
 async def add_wallets(wallets: list[dict]):
     """
     Add wallets
     """
     result = await upsert_wallets(wallets)
+    if result['upserted']:
+        mark_registry_stale()
     
     if len(result['upserted']) == 1:
         response = f'Successfully added 1 new wallet: {result["upserted"][0]["alias"]} ({format_address(result["upserted"][0]["wallet_address"])})'
@@ -279,9 +434,21 @@ async def add_tokens(tokens: list[str]):
     """
     Add tokens
     """
-    tokens = [await get_token_info(token) for token in tokens]
-
-    result = await upsert_tokens(tokens)
+    # Tokens already tracked are reported as skipped without looking them up, the registry holds their info
+    token_addresses = list(dict.fromkeys(tokens))
+    known_tokens = [registry.tokens_by_address[address] for address in token_addresses if address in registry.tokens_by_address]
+    new_token_addresses = [address for address in token_addresses if address not in registry.tokens_by_address]
+
+    token_infos, errors = await get_token_infos(new_token_addresses)
+    tokens = [token_infos[address] for address in new_token_addresses if address in token_infos]
+
+    result = await upsert_tokens(tokens) if tokens else {'upserted': [], 'conflicts': []}
+    if result['upserted']:
+        mark_registry_stale()
+    result['conflicts'] += [
+        {'token_address': token['token_address'], 'name': token['name'], 'symbol': token['symbol']}
+        for token in known_tokens
+    ]
 
     if len(result['upserted']) == 1:
         token = result['upserted'][0]
@@ -295,40 +462,64 @@ async def add_tokens(tokens: list[str]):
             for c in result['conflicts']
         )
         response += f'\nSkipped existing tokens: {conflict_list}'
+
+    if errors:
+        error_list = ", ".join(f'{address} ({str(error)})' for address, error in errors.items())
+        response += f'\nFailed to look up tokens: {error_list}'
     
     return response
 
-async def check_trades(status_callback=None):
+async def check_trades(status_callback=None, notification_channel=None):
     """
     Check the trades of wallets, currently only one's personal wallets to prevent spam.
     Personal wallets are defined by the WALLET_ALIASES list.
     e.g. Phantom 1, Phantom 2, etc will be checked.
+    notification_channel: if set, new trades are also queued in the notification outbox in the same transaction
     """
-    trade_wallets = [wallet for wallet in wallets if any(alias in wallet['alias'] for alias in TRADE_WALLET_ALIASES)]
-    trades = pd.DataFrame()
-
-    for wallet in trade_wallets:
-        if status_callback:
-            await status_callback(f'Checking trades for wallet: {wallet["alias"]}...')
-        df = await get_wallet_trades(wallet['wallet_address'])
-        df = df.assign(wallet_address=wallet['wallet_address'])
-
-        trades = pd.concat([trades, df])
+    with metrics.timer('check_trades'):
+        trade_wallets = registry.trade_wallets
+        trades = pd.DataFrame()
+        trade_cursors = {cursor['wallet_address']: cursor for cursor in await get_wallet_trade_cursors()}
+
+        for wallet in trade_wallets:
+            if status_callback:
+                await status_callback(f'Checking trades for wallet: {wallet["alias"]}...')
+
+            # Only fetch trades newer than the last one we have seen
+            trade_cursor = trade_cursors.get(wallet['wallet_address'])
+            df = await get_wallet_trades(
+                wallet['wallet_address'],
+                since_tx_hash=trade_cursor['last_tx_hash'] if trade_cursor else None,
+                since_time=trade_cursor['last_timestamp'] if trade_cursor else None,
+            )
+            if len(df) == 0:
+                continue
+            df = df.assign(wallet_address=wallet['wallet_address'])
+
+            trades = pd.concat([trades, df], ignore_index=True)
     
-    previous_trades = pd.DataFrame(await get_previous_wallet_trades())
-
-    # Update trades in db
-    new_trades = trades[~trades['tx_hash'].isin(previous_trades['tx_hash'])]
-
-    if len(new_trades) > 0:
-        await upsert_wallet_trades(list(zip(
-            new_trades['tx_hash'],
-            new_trades['wallet_address'],
-            new_trades['from_token'],
-            new_trades['to_token'],
-            new_trades['price'],
-            new_trades['volume'],
-            new_trades['timestamp']
+        if len(trades) == 0:
+            return []
+
+        # Insert trades, the db skips ones already stored and returns only the new ones
+        inserted = await upsert_wallet_trades(list(zip(
+            trades['tx_hash'],
+            trades['wallet_address'],
+            trades['from_token'],
+            trades['to_token'],
+            trades['price'],
+            trades['volume'],
+            trades['timestamp']
+        )), notification_channel)
+        inserted_tx_hashes = {trade['tx_hash'] for trade in inserted}
+        new_trades = trades[trades['tx_hash'].isin(inserted_tx_hashes)].drop_duplicates(subset=['tx_hash'])
+
+        # Move each wallet's cursor to the newest trade fetched, only once the trades are stored
+        newest_trades = trades.loc[trades.groupby('wallet_address')['timestamp'].idxmax()]
+        await upsert_wallet_trade_cursors(list(zip(
+            newest_trades['wallet_address'],
+            newest_trades['tx_hash'],
+            newest_trades['timestamp']
         )))
 
-    return new_trades.to_dict(orient='records')
+        return new_trades.to_dict(orient='records')
\ No newline at end of file